@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pandas as pd
+import logging
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+def piecewise_weights(x, knots):
+	"""
+	Anchor weights that interpolate piecewise-linearly between knots.
+
+	Args:
+		x (float): The parameter value.
+		knots (Sequence[float]): The increasing parameter value at which
+			each anchor has all the weight.
+
+	Returns:
+		numpy.ndarray: One weight per anchor, summing to one.  Values
+		outside the knots are clipped to the end anchors.
+	"""
+	knots = np.asarray(knots, dtype=np.float64)
+	weights = np.zeros(len(knots))
+	x = min(max(float(x), knots[0]), knots[-1])
+	i = min(int(np.searchsorted(knots, x, side='right')) - 1, len(knots) - 2)
+	t = (x - knots[i]) / (knots[i + 1] - knots[i])
+	weights[i] = 1.0 - t
+	weights[i + 1] = t
+	return weights
+
+
+class BlendBasis:
+	"""
+	Input files for K anchor scenarios, stacked for blending.
+
+	The files in each anchor folder are read once and the mixed columns
+	stacked into a basis array of shape (K, rows * columns) per file, so
+	any combination of the anchors is K vectorized multiply-adds over
+	contiguous arrays, with no parsing or alignment per experiment.  The
+	first anchor is the template: it gives the files, the columns that
+	are not mixed, and the column types.  Results match
+	`VEModel._manipulate_by_mixture` for two anchors: missing values are
+	mixed as zeros, integer columns are rounded unless `float_dtypes`, and
+	for a file with any missing values in the template, zeros are written
+	back as missing.
+
+	Args:
+		anchor_dirs (Sequence[str]): The anchor folders, in order.
+		no_mix_cols (Collection[str], default ('Year', 'Geo')):
+			Columns that are not mixed.
+		float_dtypes (bool, default False):
+			Mix integer columns as floats, without rounding.
+
+	Raises:
+		FileNotFoundError: If an anchor is missing a template file.
+		ValueError: If an anchor file does not align with the template.
+	"""
+
+	def __init__(self, anchor_dirs, no_mix_cols=('Year', 'Geo'), float_dtypes=False):
+		self.anchor_dirs = list(anchor_dirs)
+		if len(self.anchor_dirs) < 2:
+			raise ValueError("blending needs at least two anchors")
+		self.files = {}
+		for i in os.scandir(self.anchor_dirs[0]):
+			if not i.is_file():
+				continue
+			template = pd.read_csv(i.path)
+			isna_ = bool(template.isnull().values.any())
+			template = template.fillna(0)
+
+			float_cols = list(template.select_dtypes('float').columns)
+			int_cols = list(template.select_dtypes('int').columns)
+			if float_dtypes:
+				float_cols, int_cols = float_cols + int_cols, []
+			float_cols = [c for c in float_cols if c not in no_mix_cols]
+			int_cols = [c for c in int_cols if c not in no_mix_cols]
+			mix_cols = float_cols + int_cols
+
+			stack = [template[mix_cols].to_numpy(dtype=np.float64)]
+			for anchor_dir in self.anchor_dirs[1:]:
+				filename = os.path.join(anchor_dir, i.name)
+				if not os.path.exists(filename):
+					raise FileNotFoundError(filename)
+				df = pd.read_csv(filename).fillna(0)
+				missing = [c for c in mix_cols if c not in df.columns]
+				if missing or len(df) != len(template):
+					raise ValueError(f"{filename} does not align with {i.path}")
+				stack.append(df[mix_cols].to_numpy(dtype=np.float64))
+			basis = np.stack(stack).reshape(len(stack), -1)
+			self.files[i.name] = (template, isna_, float_cols, int_cols, np.ascontiguousarray(basis))
+
+	def blend(self, weights):
+		"""
+		Blend the anchors.
+
+		Args:
+			weights (Sequence[float]): One weight per anchor.
+
+		Returns:
+			dict: A DataFrame for each file name.
+		"""
+		weights = np.asarray(weights, dtype=np.float64)
+		if len(weights) != len(self.anchor_dirs):
+			raise ValueError(f"expected {len(self.anchor_dirs)} weights, not {len(weights)}")
+		result = {}
+		for filename, (template, isna_, float_cols, int_cols, basis) in self.files.items():
+			df = template.copy()
+			# Summed anchor by anchor, rather than by one BLAS product, so
+			# the rounding matches _manipulate_by_mixture exactly.
+			mixed = basis[0] * weights[0]
+			for k in range(1, len(weights)):
+				mixed = mixed + basis[k] * weights[k]
+			mixed = mixed.reshape(len(template), -1)
+			if float_cols:
+				df[float_cols] = mixed[:, :len(float_cols)]
+			if int_cols:
+				df[int_cols] = np.round(mixed[:, len(float_cols):]).astype(int)
+			if isna_:
+				df.replace(0, np.nan, inplace=True)
+			result[filename] = df
+		return result
+
+	def write(self, weights, directory):
+		"""Blend the anchors and write the files into `directory`."""
+		for filename, df in self.blend(weights).items():
+			df.to_csv(os.path.join(directory, filename), index=False, float_format="%.5f", na_rep='NA')
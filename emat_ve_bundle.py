@@ -0,0 +1,178 @@
+import os
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import namedtuple
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+ModelBundle = namedtuple('ModelBundle', ['name', 'digest', 'path'])
+
+# The marker written into an unpacked model, holding the bundle digest.
+BUNDLE_MARKER = '.emat_bundle'
+
+_unpack_lock = threading.Lock()
+
+
+def model_digest(model_dir):
+	"""
+	A content hash of a model directory.
+
+	The hash covers the relative path and bytes of every file, walked in
+	sorted order, so it is the same for the same model on any machine.
+
+	Args:
+		model_dir (str): The installed model directory.
+
+	Returns:
+		str: The hex SHA-256 digest.
+	"""
+	digest = hashlib.sha256()
+	for root, dirs, files in os.walk(model_dir):
+		dirs.sort()
+		for filename in sorted(files):
+			if filename == BUNDLE_MARKER:
+				continue
+			path = os.path.join(root, filename)
+			digest.update(os.path.relpath(path, model_dir).replace(os.sep, '/').encode())
+			digest.update(b'\0')
+			with open(path, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 20), b''):
+					digest.update(block)
+			digest.update(b'\0')
+	return digest.hexdigest()
+
+
+def build_bundle(model_dir, cache_dir):
+	"""
+	Pack a model directory into a compressed, content-hashed bundle.
+
+	The bundle is named for the model and its digest, so a bundle
+	already in `cache_dir` for the same content is reused rather than
+	packed again.
+
+	Args:
+		model_dir (str): The installed model directory.
+		cache_dir (str): The directory to keep bundles in.
+
+	Returns:
+		ModelBundle: The bundle `name`, content `digest` and `path`.
+	"""
+	digest = model_digest(model_dir)
+	name = f"{os.path.basename(os.path.normpath(model_dir))}-{digest[:16]}.tar.gz"
+	path = os.path.abspath(os.path.join(cache_dir, name))
+	if os.path.exists(path):
+		_logger.info(f"BUNDLE {name} found in {cache_dir}")
+		return ModelBundle(name, digest, path)
+	os.makedirs(cache_dir, exist_ok=True)
+	handle, partial = tempfile.mkstemp(suffix='.partial', dir=cache_dir)
+	os.close(handle)
+	try:
+		with tarfile.open(partial, 'w:gz') as tar:
+			tar.add(model_dir, arcname='.', filter=lambda info: None if info.name.endswith(BUNDLE_MARKER) else info)
+		os.replace(partial, path)
+	except BaseException:
+		os.remove(partial)
+		raise
+	_logger.info(f"BUNDLE {name} built, {os.path.getsize(path) / 2**20:.1f} MB")
+	return ModelBundle(name, digest, path)
+
+
+def find_bundle(bundle, search_dirs):
+	"""
+	Find a bundle on this machine.
+
+	Args:
+		bundle (ModelBundle): The bundle to find.
+		search_dirs (Iterable[str]): Directories to look in, in order;
+			the directory of `bundle.path` is tried last.
+
+	Returns:
+		str or None: The path of the bundle, if found.
+	"""
+	for directory in list(search_dirs) + [os.path.dirname(bundle.path)]:
+		if directory:
+			path = os.path.join(directory, bundle.name)
+			if os.path.isfile(path):
+				return path
+	return None
+
+
+def _extract_all(tar, path):
+	"""
+	Extract a bundle, refusing members that would land outside `path`.
+
+	Pythons with tar extraction filters use the 'data' filter; older
+	ones check each member's path and type first.
+	"""
+	if hasattr(tarfile, 'data_filter'):
+		tar.extractall(path, filter='data')
+		return
+	root = os.path.realpath(path)
+	for member in tar.getmembers():
+		target = os.path.realpath(os.path.join(root, member.name))
+		if os.path.commonpath([root, target]) != root:
+			raise tarfile.TarError(f"bundle member {member.name} is outside the model directory")
+		if member.issym() or member.islnk() or member.isdev():
+			raise tarfile.TarError(f"bundle member {member.name} is a link or device")
+	tar.extractall(path)
+
+
+def worker_bundle_path(bundle, cache_dir=None, dask_worker=None):
+	"""
+	Find a bundle on a dask worker, for `Client.run`.
+
+	Args:
+		bundle (ModelBundle): The bundle to find.
+		cache_dir (str, optional): A bundle cache to look in after the
+			worker's local directory.
+		dask_worker (dask.distributed.Worker): Given by `Client.run`.
+
+	Returns:
+		str or None: The path of the bundle on the worker, if found.
+	"""
+	return find_bundle(bundle, [dask_worker.local_directory, cache_dir])
+
+
+def unpack_bundle(bundle, bundle_path, model_dir):
+	"""
+	Unpack a bundle into a model directory, unless it already holds it.
+
+	The model is unpacked beside `model_dir` and then moved into place,
+	with a marker holding the digest, so an interrupted unpack is never
+	mistaken for a complete one.  A model directory holding a different
+	digest is replaced.
+
+	Args:
+		bundle (ModelBundle): The bundle.
+		bundle_path (str): Where the bundle is on this machine.
+		model_dir (str): The model directory to unpack into.
+
+	Returns:
+		bool: True if the bundle was unpacked, False if it was already there.
+	"""
+	marker = os.path.join(model_dir, BUNDLE_MARKER)
+	with _unpack_lock:
+		if os.path.exists(marker):
+			with open(marker, 'rt') as f:
+				if f.read().strip() == bundle.digest:
+					return False
+		parent = os.path.dirname(os.path.abspath(model_dir))
+		os.makedirs(parent, exist_ok=True)
+		staging = tempfile.mkdtemp(prefix='.unpack-', dir=parent)
+		try:
+			with tarfile.open(bundle_path, 'r:gz') as tar:
+				_extract_all(tar, staging)
+			with open(os.path.join(staging, BUNDLE_MARKER), 'wt') as f:
+				f.write(bundle.digest)
+			if os.path.exists(model_dir):
+				shutil.rmtree(model_dir)
+			os.replace(staging, model_dir)
+		except BaseException:
+			shutil.rmtree(staging, ignore_errors=True)
+			raise
+	_logger.info(f"BUNDLE {bundle.name} unpacked to {model_dir}")
+	return True
@@ -0,0 +1,327 @@
+import os
+import queue
+import logging
+import sqlite3
+import threading
+import pandas as pd
+from multiprocessing.connection import Listener, Client
+
+from emat import SQLiteDB
+
+from emat_ve_failures import write_ve_failure
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+def enable_wal(database_path, busy_timeout=30000):
+	"""
+	Switch a SQLite database file to write-ahead logging.
+
+	In WAL mode readers see a consistent snapshot and are not blocked
+	by the writer, and the writer is not blocked by readers.  The mode
+	is persistent, so this only needs to be done once per file.
+
+	Args:
+		database_path (str): Path to the SQLite database file.
+		busy_timeout (int, default 30000): Milliseconds to wait on a lock.
+	"""
+	conn = sqlite3.connect(database_path, timeout=busy_timeout / 1000)
+	try:
+		mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+	finally:
+		conn.close()
+	if mode.lower() != 'wal':
+		_logger.warning(f"could not enable WAL on {database_path}, journal_mode is {mode}")
+
+
+# Put on the writer's queue to stop the writer thread.
+_STOP = None
+
+
+class MeasureWriter:
+	"""
+	A single writer that commits database writes sent by all workers.
+
+	The writer listens on a socket for write requests from
+	`QueuedWriteDB` handles on the workers.  Requests are put on a queue
+	and committed in the order they arrive by one thread that owns the
+	only writing connection to the database, so workers never contend
+	for the database lock.  Consecutive measure writes are coalesced
+	into one `write_experiment_measures` call, and so one transaction.
+
+	Writes that do not wait for a reply can still fail.  Each failure is
+	sent back to the worker that made the write, whose next write
+	raises it, and is raised by the next `flush` (or `stop`) here.  The
+	run status of an experiment whose measures failed to commit is
+	stored as a PROBLEM rather than as COMPLETE.
+
+	Args:
+		database_path (str): Path to the SQLite database file.
+		host (str, default 'localhost'): The interface to listen on.
+			Use a reachable host name if workers run on other machines.
+		port (int, default 0): The port to listen on; 0 picks a free port.
+		batch_size (int, default 64): Most requests committed per batch.
+	"""
+
+	def __init__(self, database_path, host='localhost', port=0, batch_size=64):
+		self.database_path = database_path
+		self.batch_size = batch_size
+		self.authkey = os.urandom(16)
+		self._listener = Listener((host, port), authkey=self.authkey)
+		self.address = self._listener.address
+		self._queue = queue.Queue()
+		self._stop = threading.Event()
+		self._threads = []
+		self._failed = []
+		self._failed_lock = threading.Lock()
+		self._failed_runs = {}
+
+	def start(self):
+		"""Start the listener and writer threads."""
+		enable_wal(self.database_path)
+		for target in (self._accept, self._write):
+			thread = threading.Thread(target=target, name=f"MeasureWriter{target.__name__}", daemon=True)
+			thread.start()
+			self._threads.append(thread)
+		_logger.info(f"MEASURE WRITER listening on {self.address}")
+		return self
+
+	def flush(self):
+		"""
+		Block until every request received so far is committed.
+
+		Raises:
+			RuntimeError: If any write that did not wait for a reply
+				failed since the last flush.
+		"""
+		self._queue.join()
+		with self._failed_lock:
+			failed, self._failed = self._failed, []
+		if failed:
+			raise RuntimeError(f"MEASURE WRITER failed {len(failed)} writes: " + "; ".join(failed))
+
+	def stop(self):
+		"""Commit outstanding requests and shut down."""
+		try:
+			self.flush()
+		finally:
+			self._stop.set()
+			self._queue.put(_STOP)
+			# Wake the accept loop with a connection of our own.
+			try:
+				Client(self.address, authkey=self.authkey).close()
+			except OSError:
+				pass
+			for thread in self._threads:
+				thread.join()
+			self._listener.close()
+			self._threads = []
+
+	def _accept(self):
+		while True:
+			try:
+				conn = self._listener.accept()
+			except OSError:
+				break
+			if self._stop.is_set():
+				conn.close()
+				break
+			threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+	def _receive(self, conn):
+		# Replies and failure notices are sent from different threads.
+		send_lock = threading.Lock()
+
+		def notify(message):
+			with send_lock:
+				try:
+					conn.send(('failed', message))
+				except OSError:
+					pass
+
+		with conn:
+			while True:
+				try:
+					method, args, kwargs, wants_reply = conn.recv()
+				except (EOFError, OSError):
+					break
+				reply = {'done': threading.Event()} if wants_reply else None
+				self._queue.put((method, args, kwargs, reply, notify))
+				if reply is not None:
+					reply['done'].wait()
+					with send_lock:
+						conn.send(('reply', (reply.get('result'), reply.get('error'))))
+
+	def _write(self):
+		db = SQLiteDB(self.database_path, initialize='skip', check_same_thread=False)
+		db.conn.execute("PRAGMA busy_timeout = 30000")
+		stopping = False
+		while not stopping:
+			batch = [self._queue.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			requests = [request for request in batch if request is not _STOP]
+			stopping = len(requests) < len(batch)
+			try:
+				self._commit(db, requests)
+			finally:
+				for _ in batch:
+					self._queue.task_done()
+
+	def _report(self, notify, message):
+		with self._failed_lock:
+			self._failed.append(message)
+		notify(message)
+
+	def _commit(self, db, batch):
+		# Runs of measure writes for the same scope and source are
+		# committed together, but never after a request that came later.
+		pending = []
+		for request in batch:
+			method, args, kwargs, reply, notify = request
+			if method == 'write_experiment_measures' and reply is None and kwargs.get('run_ids') is not None:
+				if pending and pending[0][1][:2] != args[:2]:
+					self._commit_measures(db, pending)
+					pending = []
+				pending.append(request)
+				continue
+			if pending:
+				self._commit_measures(db, pending)
+				pending = []
+			if method == 'write_experiment_run_status' and str(args[1]) in self._failed_runs:
+				args = args[:3] + (f"PROBLEM: measures not stored: {self._failed_runs[str(args[1])]!r}",)
+			try:
+				if method == 'write_ve_failure':
+					result = write_ve_failure(db, *args)
+				else:
+					result = getattr(db, method)(*args, **kwargs)
+			except Exception as err:
+				_logger.exception(f"MEASURE WRITER {method} failed")
+				if reply is not None:
+					reply['error'] = err
+				else:
+					self._report(notify, f"{method}: {err!r}")
+			else:
+				if reply is not None:
+					reply['result'] = result
+			finally:
+				if reply is not None:
+					reply['done'].set()
+		if pending:
+			self._commit_measures(db, pending)
+
+	def _commit_measures(self, db, requests):
+		scope_name, source = requests[0][1][:2]
+		try:
+			db.write_experiment_measures(
+				scope_name,
+				source,
+				pd.concat([args[2] for _, args, _, _, _ in requests]),
+				[run_id for _, _, kwargs, _, _ in requests for run_id in kwargs['run_ids']],
+			)
+		except Exception:
+			_logger.exception(
+				f"MEASURE WRITER write_experiment_measures failed for {len(requests)} experiments, "
+				f"retrying them one by one"
+			)
+		else:
+			_logger.debug(f"MEASURE WRITER committed {len(requests)} experiments of {scope_name}")
+			return
+		for _, args, kwargs, _, notify in requests:
+			try:
+				db.write_experiment_measures(*args, run_ids=kwargs['run_ids'])
+			except Exception as err:
+				_logger.exception(f"MEASURE WRITER measures of runs {kwargs['run_ids']} not stored")
+				for run_id in kwargs['run_ids']:
+					self._failed_runs[str(run_id)] = err
+				self._report(notify, f"measures of runs {kwargs['run_ids']}: {err!r}")
+
+
+class QueuedWriteDB(SQLiteDB):
+	"""
+	A worker's database handle that reads locally and writes via a MeasureWriter.
+
+	Reads go through a read-only connection, which in WAL mode sees a
+	consistent snapshot without blocking or being blocked by the writer.
+	The write methods used while running experiments are forwarded to
+	the `MeasureWriter`: those that return values wait for the reply,
+	the rest return immediately.  If one of those later fails to
+	commit, the next write through this handle raises RuntimeError.
+
+	Args:
+		database_path (str): Path to the SQLite database file.
+		address (tuple): The (host, port) of the MeasureWriter.
+		authkey (bytes): The MeasureWriter's authentication key.
+	"""
+
+	def __init__(self, database_path, address, authkey):
+		super().__init__(database_path, readonly=True, check_same_thread=False)
+		self.conn.execute("PRAGMA busy_timeout = 30000")
+		# Writes are forwarded, so this handle is not read-only to its users.
+		self.readonly = False
+		self._address = address
+		self._authkey = authkey
+		self._client = None
+		self._client_lock = threading.Lock()
+
+	def _send(self, method, args, kwargs, wants_reply):
+		with self._client_lock:
+			if self._client is None:
+				self._client = Client(self._address, authkey=self._authkey)
+			self._client.send((method, args, kwargs, wants_reply))
+			failed = []
+			result = error = None
+			if wants_reply:
+				while True:
+					kind, payload = self._client.recv()
+					if kind == 'reply':
+						result, error = payload
+						break
+					failed.append(payload)
+			# Earlier writes that did not wait for a reply and failed.
+			while self._client.poll():
+				kind, payload = self._client.recv()
+				failed.append(payload)
+			if failed:
+				raise RuntimeError(f"earlier database writes failed: {'; '.join(failed)}")
+			if error is not None:
+				raise error
+			return result
+
+	def new_run_id(self, scope_name=None, parameters=None, location=None, experiment_id=None, source=0, **extra_attrs):
+		return self._send(
+			'new_run_id',
+			(),
+			dict(
+				scope_name=scope_name, parameters=parameters, location=location,
+				experiment_id=experiment_id, source=source, **extra_attrs
+			),
+			True,
+		)
+
+	def write_experiment_parameters(self, *args, **kwargs):
+		return self._send('write_experiment_parameters', args, kwargs, True)
+
+	def write_experiment_parameters_1(self, *args, **kwargs):
+		# Called by run_model for ad hoc experiments, which have no id yet.
+		return self._send('write_experiment_parameters_1', args, kwargs, True)
+
+	def write_experiment_run_status(self, scope_name, run_id, experiment_id, msg):
+		self._send('write_experiment_run_status', (scope_name, run_id, experiment_id, msg), {}, False)
+
+	def write_experiment_measures(self, scope_name, source, m_df, run_ids=None, experiment_id=None):
+		self._send(
+			'write_experiment_measures',
+			(scope_name, source, m_df),
+			dict(run_ids=run_ids, experiment_id=experiment_id),
+			False,
+		)
+
+	def write_ve_failure(self, record):
+		self._send('write_ve_failure', (record,), {}, False)
+
+	def log(self, message, level=logging.INFO):
+		_logger.log(level, str(message))
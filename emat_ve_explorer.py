@@ -0,0 +1,249 @@
+import json
+import threading
+import numpy as np
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from scipy.linalg import solve_triangular
+from scipy.stats import norm
+
+from emat_ve_metamodel import _output_transforms
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+class ScenarioExplorer:
+	"""
+	Fast what-if queries over the policy levers using a fitted metamodel.
+
+	The metamodel is compiled into a few contiguous arrays: training
+	points pre-divided by the length scales with their squared norms,
+	the trend and kernel weights folded into the output scale, and the
+	Cholesky factor for predictive variance.  A query encodes the lever
+	values straight into a feature array, so each batch is one kernel
+	matrix and two matrix products, with no pandas in the path.
+
+	Parameters not given in a query are held at their scope defaults,
+	or at the values set with `set_defaults`.
+
+	Args:
+		engine (MetamodelEngine): A fitted engine.
+		scope (emat.Scope): The scope of the engine.
+	"""
+
+	def __init__(self, engine, scope):
+		gp = engine.metamodel
+		if gp is None:
+			raise ValueError("the metamodel engine is not fitted")
+		self.scope_name = engine.scope_name
+		self.experiment_set = engine.experiment_set
+		self.measure_names = list(engine.measure_names)
+		self.lever_names = [p.name for p in scope.get_levers()]
+		self.uncertainty_names = [p.name for p in scope.get_uncertainties()]
+
+		# Encoding, as (name, kind, info, first feature column).
+		self._columns = []
+		n_features = 0
+		for name, kind, info in engine.encoder.columns:
+			self._columns.append((name, kind, info, n_features))
+			n_features += len(info) if kind == 'cat' else 1
+		self.n_features = n_features
+		self._defaults = {p.name: p.default for p in scope.get_uncertainties() + scope.get_levers()}
+		self._default_features = self._encode({})
+
+		ls = np.asarray(gp.length_scales, dtype=np.float64)
+		self._inv_ls = 1.0 / ls
+		self._Xs = np.ascontiguousarray(gp.X_ * self._inv_ls)
+		self._Xs_sq = (self._Xs**2).sum(1)
+		scale = gp.y_scale_
+		self._beta = np.ascontiguousarray(gp.beta_ * scale)
+		self._beta[0] += gp.y_mean_
+		self._alpha = np.ascontiguousarray(gp.alpha_ * scale)
+		self._L = np.ascontiguousarray(np.tril(gp.chol_[0]))
+		self._prior_var = 1.0 + gp.nugget
+		self._std_scale = np.sqrt(gp.sigma2_) * scale
+		self._inverse = [
+			(j, _output_transforms[engine.transforms[name]][1])
+			for j, name in enumerate(self.measure_names)
+			if name in engine.transforms
+		]
+
+	def set_defaults(self, **values):
+		"""Set the values used for parameters not given in a query."""
+		unknown = set(values) - set(self._defaults)
+		if unknown:
+			raise KeyError(f"not parameters of {self.scope_name}: {', '.join(sorted(unknown))}")
+		self._defaults.update(values)
+		self._default_features = self._encode({})
+
+	def _encode(self, values):
+		n = max((np.size(v) for v in values.values()), default=1)
+		X = np.empty((n, self.n_features))
+		for name, kind, info, j in self._columns:
+			x = np.asarray(values.get(name, self._defaults[name]))
+			if kind == 'cat':
+				for k, level in enumerate(info):
+					X[:, j + k] = (x == level)
+			elif kind == 'bool':
+				X[:, j] = x.astype(np.float64)
+			else:
+				lo, span = info
+				X[:, j] = (x.astype(np.float64) - lo) / span
+		return X
+
+	def query(self, values=None, bands=True, level=0.9, **kwargs):
+		"""
+		Predict all measures for a batch of parameter settings.
+
+		Args:
+			values (Mapping, optional):
+				Parameter values, each a scalar or an array; arrays give
+				one query row per element.  Keyword arguments are
+				added to these.
+			bands (bool, default True):
+				Also return the lower and upper uncertainty bands.
+			level (float, default 0.9):
+				The central probability covered by the bands.
+
+		Returns:
+			dict: 'mean', and with `bands` also 'lower' and 'upper',
+			each an array of shape (n_queries, n_measures) in the order
+			of `measure_names`.
+		"""
+		values = dict(values or {}, **kwargs)
+		unknown = set(values) - set(self._defaults)
+		if unknown:
+			raise KeyError(f"not parameters of {self.scope_name}: {', '.join(sorted(unknown))}")
+		X = self._encode(values) if values else self._default_features
+		Xs = X * self._inv_ls
+		sq = (Xs**2).sum(1)[:, None] + self._Xs_sq[None, :] - 2.0 * Xs @ self._Xs.T
+		k = np.exp(-0.5 * np.maximum(sq, 0.0))
+		mean = X @ self._beta[1:] + self._beta[0] + k @ self._alpha
+		result = {'mean': mean}
+		if bands:
+			v = solve_triangular(self._L, k.T, lower=True, check_finite=False)
+			var = np.maximum(self._prior_var - (v**2).sum(0), 0.0)
+			half = norm.ppf(0.5 + level / 2) * np.sqrt(var)[:, None] * self._std_scale[None, :]
+			result['lower'] = mean - half
+			result['upper'] = mean + half
+		# Transforms are monotone, so bands map straight through them.
+		for key in result:
+			for j, inverse in self._inverse:
+				result[key][:, j] = inverse(result[key][:, j])
+		return result
+
+	def sweep(self, name, n=25, bands=True, **values):
+		"""
+		Predict all measures across the range of one parameter.
+
+		Args:
+			name (str): The parameter to vary.
+			n (int, default 25): The number of points for a numeric parameter.
+			bands (bool, default True): Also return uncertainty bands.
+			**values: Values for other parameters.
+
+		Returns:
+			dict: As `query`, plus the swept 'values'.
+		"""
+		for p_name, kind, info, _ in self._columns:
+			if p_name == name:
+				break
+		else:
+			raise KeyError(f"{name} is not a varying parameter of {self.scope_name}")
+		if kind == 'cat':
+			grid = np.asarray(info)
+		elif kind == 'bool':
+			grid = np.array([False, True])
+		else:
+			lo, span = info
+			grid = np.linspace(lo, lo + span, n)
+		values[name] = grid
+		result = self.query(values, bands=bands)
+		result['values'] = grid
+		return result
+
+
+class _ExplorerHandler(BaseHTTPRequestHandler):
+
+	def _reply(self, status, body):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		explorer = self.server.explorer
+		if self.path.rstrip('/') in ('', '/info'):
+			self._reply(200, {
+				'scope': explorer.scope_name,
+				'experiment_set': explorer.experiment_set,
+				'measures': explorer.measure_names,
+				'levers': explorer.lever_names,
+				'uncertainties': explorer.uncertainty_names,
+			})
+		else:
+			self._reply(404, {'error': f"unknown path {self.path}"})
+
+	def do_POST(self):
+		if self.path.rstrip('/') != '/query':
+			self._reply(404, {'error': f"unknown path {self.path}"})
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+			result = self.server.explorer.query(
+				request.get('values'),
+				bands=request.get('bands', True),
+				level=request.get('level', 0.9),
+			)
+		except (KeyError, ValueError, TypeError) as err:
+			self._reply(400, {'error': str(err)})
+			return
+		body = {key: array.tolist() for key, array in result.items()}
+		body['measures'] = self.server.explorer.measure_names
+		self._reply(200, body)
+
+	def log_message(self, format, *args):
+		_logger.debug(f"EXPLORER {self.address_string()} {format % args}")
+
+
+class ExplorerService:
+	"""
+	A local HTTP service answering ScenarioExplorer queries.
+
+	`GET /info` describes the scope, and `POST /query` takes a JSON body
+	like `{"values": {"TAXSCEN": [0.1, 0.5, 0.9]}, "level": 0.9}` and
+	returns the mean, lower and upper predictions for every measure.
+
+	Args:
+		explorer (ScenarioExplorer): The explorer to serve.
+		host (str, default '127.0.0.1'): The interface to listen on.
+		port (int, default 0): The port to listen on; 0 picks a free port.
+	"""
+
+	def __init__(self, explorer, host='127.0.0.1', port=0):
+		self.explorer = explorer
+		self._server = ThreadingHTTPServer((host, port), _ExplorerHandler)
+		self._server.explorer = explorer
+		self.address = self._server.server_address
+		self._thread = None
+
+	@property
+	def url(self):
+		"""str: The base URL of the service."""
+		return f"http://{self.address[0]}:{self.address[1]}"
+
+	def start(self):
+		"""Serve requests in a background thread."""
+		self._thread = threading.Thread(target=self._server.serve_forever, name="ExplorerService", daemon=True)
+		self._thread.start()
+		_logger.info(f"EXPLORER serving {self.explorer.scope_name} at {self.url}")
+		return self
+
+	def stop(self):
+		"""Stop serving."""
+		self._server.shutdown()
+		self._server.server_close()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
@@ -0,0 +1,316 @@
+import re
+import json
+import time
+import socket
+import hashlib
+import numpy as np
+import pandas as pd
+import logging
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+_CREATE_FAILURES = """
+CREATE TABLE IF NOT EXISTS ve_failures (
+	scope_name TEXT NOT NULL,
+	experiment_id INTEGER,
+	run_id TEXT,
+	stage TEXT,
+	module TEXT,
+	signature TEXT,
+	message TEXT,
+	duration REAL,
+	params TEXT,
+	host TEXT,
+	recorded REAL
+)
+"""
+
+_CREATE_FAILURES_INDEX = """
+CREATE INDEX IF NOT EXISTS ve_failures_signature ON ve_failures (scope_name, signature)
+"""
+
+_FAILURE_COLUMNS = (
+	'scope_name', 'experiment_id', 'run_id', 'stage', 'module', 'signature',
+	'message', 'duration', 'params', 'host', 'recorded',
+)
+
+# VE logs each module as it starts, e.g. "Starting module 'CalculateHouseholdDvmt'
+# for year '2038'" or "Running module CalculateHouseholdDvmt from package VEHouseholdTravel".
+_module_pattern = re.compile(
+	r"""(?:starting|running|run)\s+module\s+['"]?(\w+)['"]?(?:\s+(?:from|in|of)\s+package\s+['"]?(\w+)['"]?)?""",
+	re.IGNORECASE,
+)
+_error_pattern = re.compile(r"\berror\b", re.IGNORECASE)
+# Paths start at a root, a drive, ~ or . and have no spaces, so "km/h"
+# and the words around a path are left alone.
+_path_pattern = re.compile(r"""(?<![\w.~\\/-])(?:[A-Za-z]:|~|\.{1,2})?(?:[\\/]+[\w.~-]+)+""")
+_number_pattern = re.compile(r"\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", re.IGNORECASE)
+
+
+def failing_module(log_text):
+	"""
+	The VE module running when a log ends.
+
+	Args:
+		log_text (str): VE console output or log file text.
+
+	Returns:
+		str or None: The last module started, as "package::module" when
+		the package is given, or None if no module was started.
+	"""
+	found = None
+	for found in _module_pattern.finditer(log_text or ''):
+		pass
+	if found is None:
+		return None
+	module, package = found.groups()
+	return f"{package}::{module}" if package else module
+
+
+def error_message(text):
+	"""
+	The error lines of R output, or the last line if there are none.
+
+	Args:
+		text (str): R console output, usually stderr.
+
+	Returns:
+		str
+	"""
+	lines = [line.strip() for line in (text or '').splitlines() if line.strip()]
+	for i, line in enumerate(lines):
+		if _error_pattern.search(line):
+			# R splits long error messages after the "Error in call :" part.
+			if line.endswith(':') and i + 1 < len(lines):
+				line = f"{line} {lines[i + 1]}"
+			return line
+	return lines[-1] if lines else ''
+
+
+def error_signature(stage, module, message):
+	"""
+	A short hash that is the same for failures with the same cause.
+
+	Paths and numbers in the message are masked, so failures that differ
+	only in the experiment's folder or values share a signature.
+
+	Args:
+		stage (str): The stage that failed.
+		module (str or None): The failing VE module.
+		message (str): The error message.
+
+	Returns:
+		str: 12 hex digits.
+	"""
+	normalized = _number_pattern.sub('<n>', _path_pattern.sub('<path>', message or ''))
+	normalized = ' '.join(normalized.split())
+	return hashlib.sha1(f"{stage}\n{module or ''}\n{normalized}".encode()).hexdigest()[:12]
+
+
+def failure_record(scope_name, experiment_id, params, stage, message, log_text='', duration=None, run_id=None):
+	"""
+	Describe a failed experiment.
+
+	Args:
+		scope_name (str): The scope.
+		experiment_id (int or None): The experiment, if known.
+		params (Mapping): The experiment's parameter values.
+		stage (str): One of 'setup', 'run', 'post_process' or 'load_measures'.
+		message (str): The error message.
+		log_text (str, optional): Model output to find the failing module in.
+		duration (float, optional): Seconds from the start of the
+			experiment to the failure.
+		run_id (optional): The run id, if any.
+
+	Returns:
+		dict: A row of the `ve_failures` table.
+	"""
+	module = failing_module(log_text)
+	params = {
+		k: (v.item() if isinstance(v, np.generic) else v)
+		for k, v in params.items()
+		if not k.startswith('_')
+	}
+	return {
+		'scope_name': scope_name,
+		'experiment_id': None if experiment_id is None else int(experiment_id),
+		'run_id': None if run_id is None else str(run_id),
+		'stage': stage,
+		'module': module,
+		'signature': error_signature(stage, module, message),
+		'message': message,
+		'duration': duration,
+		'params': json.dumps(params, default=str),
+		'host': socket.gethostname(),
+		'recorded': time.time(),
+	}
+
+
+def write_ve_failure(db, record):
+	"""
+	Store a failure record in the `ve_failures` table.
+
+	A `QueuedWriteDB` forwards the record to its `MeasureWriter`.
+
+	Args:
+		db (emat.SQLiteDB): The database.
+		record (dict): From `failure_record`.
+	"""
+	forward = getattr(db, 'write_ve_failure', None)
+	if forward is not None:
+		forward(record)
+		return
+	with db.conn:
+		db.conn.execute(_CREATE_FAILURES)
+		db.conn.execute(_CREATE_FAILURES_INDEX)
+		db.conn.execute(
+			f"INSERT INTO ve_failures VALUES ({','.join('?' * len(_FAILURE_COLUMNS))})",
+			tuple(record[c] for c in _FAILURE_COLUMNS),
+		)
+
+
+def read_failures(db, scope_name, since=None):
+	"""
+	Read the failure records of a scope.
+
+	Args:
+		db (emat.SQLiteDB): The database.
+		scope_name (str): The scope.
+		since (float, optional): Only failures recorded after this time
+			(seconds since the epoch).
+
+	Returns:
+		pandas.DataFrame: A row per failure with the columns of the
+		`ve_failures` table, except that `params` is expanded into a
+		column per parameter.
+	"""
+	exists = db.conn.execute(
+		"SELECT name FROM sqlite_master WHERE type='table' AND name='ve_failures'"
+	).fetchone()
+	if exists is None:
+		return pd.DataFrame(columns=[c for c in _FAILURE_COLUMNS if c != 'params'])
+	failures = pd.read_sql_query(
+		"SELECT * FROM ve_failures WHERE scope_name=? AND recorded>? ORDER BY recorded",
+		db.conn,
+		params=(scope_name, since or 0),
+	)
+	params = pd.DataFrame([json.loads(p) for p in failures.pop('params')], index=failures.index)
+	return failures.join(params)
+
+
+def failures_by_signature(failures):
+	"""
+	Group failures that have the same cause.
+
+	Args:
+		failures (pandas.DataFrame): From `read_failures`.
+
+	Returns:
+		pandas.DataFrame: A row per signature, most frequent first, with
+		the stage, module, an example message, the number of failures
+		and of distinct experiments, their mean duration, the experiment
+		ids and when the signature was first and last seen.
+	"""
+	if failures.empty:
+		return pd.DataFrame(columns=[
+			'stage', 'module', 'message', 'failures', 'experiments',
+			'mean_duration', 'experiment_ids', 'first_seen', 'last_seen',
+		])
+	grouped = failures.groupby('signature', sort=False)
+	summary = pd.DataFrame({
+		'stage': grouped['stage'].first(),
+		'module': grouped['module'].first(),
+		'message': grouped['message'].first(),
+		'failures': grouped.size(),
+		'experiments': grouped['experiment_id'].nunique(),
+		'mean_duration': grouped['duration'].mean(),
+		'experiment_ids': grouped['experiment_id'].agg(lambda x: sorted(int(i) for i in x.dropna().unique())),
+		'first_seen': pd.to_datetime(grouped['recorded'].min(), unit='s'),
+		'last_seen': pd.to_datetime(grouped['recorded'].max(), unit='s'),
+	})
+	return summary.sort_values('failures', ascending=False)
+
+
+def failure_regions(failures, completed, scope, bins=4, min_failures=2):
+	"""
+	Find the parts of the input space where runs fail.
+
+	Each parameter is split into quantile bins of the attempted runs
+	(or into its values, for categorical and boolean parameters), and
+	the failure rate of each bin is compared to the overall rate.  Each
+	experiment counts once: repeated failures of an experiment are
+	counted as one, and an experiment that later completed is not
+	counted as failed.
+
+	Args:
+		failures (pandas.DataFrame): From `read_failures`.
+		completed (pandas.DataFrame): The parameters of the runs that
+			completed, indexed by experiment id.
+		scope (emat.Scope): The scope.
+		bins (int, default 4): Quantile bins for numeric parameters.
+		min_failures (int, default 2): Bins with fewer failures are left out.
+
+	Returns:
+		pandas.DataFrame: A row per bin with the `parameter`, its `low`
+		and `high` values (equal for a single value), the number of
+		`runs` and `failures`, the `failure_rate`, and the `lift` over
+		the overall failure rate, highest lift first.
+	"""
+	names = [n for n in scope.get_parameter_names() if n in failures.columns and n in completed.columns]
+	ids = failures['experiment_id']
+	known = ids.notna()
+	failures = pd.concat([
+		failures.loc[known & ~ids.isin(completed.index)].drop_duplicates('experiment_id', keep='last'),
+		failures.loc[~known],
+	])
+	failed = failures[names].assign(_failed_=True)
+	attempted = pd.concat([failed, completed[names].assign(_failed_=False)], ignore_index=True)
+	overall = failed.shape[0] / max(attempted.shape[0], 1)
+	rows = []
+	for p in scope.get_parameters():
+		if p.name not in names:
+			continue
+		x = attempted[p.name]
+		if p.dtype in ('cat', 'bool') or x.nunique() <= bins:
+			keys = x.astype(str)
+			groups = attempted.groupby(keys)['_failed_']
+			for level, outcome in groups:
+				value = x[keys == level].iloc[0]
+				rows.append((p.name, value, value, len(outcome), int(outcome.sum())))
+		else:
+			x = x.astype(np.float64)
+			edges = np.unique(np.quantile(x, np.linspace(0, 1, bins + 1)))
+			codes = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+			for code, outcome in attempted.groupby(codes)['_failed_']:
+				rows.append((p.name, edges[code], edges[code + 1], len(outcome), int(outcome.sum())))
+	regions = pd.DataFrame(rows, columns=['parameter', 'low', 'high', 'runs', 'failures'])
+	regions = regions.loc[regions['failures'] >= min_failures]
+	regions['failure_rate'] = regions['failures'] / regions['runs']
+	regions['lift'] = regions['failure_rate'] / overall if overall else np.nan
+	return regions.sort_values(['lift', 'failures'], ascending=False).reset_index(drop=True)
+
+
+def in_failure_regions(design, regions, min_rate=0.5):
+	"""
+	Flag experiments that fall in a failing region.
+
+	Args:
+		design (pandas.DataFrame): Experiment parameters.
+		regions (pandas.DataFrame): From `failure_regions`.
+		min_rate (float, default 0.5): The failure rate that makes a
+			region one to avoid.
+
+	Returns:
+		pandas.Series: True for each experiment in any region with at
+		least `min_rate` failures.
+	"""
+	flagged = pd.Series(False, index=design.index)
+	for region in regions.loc[regions['failure_rate'] >= min_rate].itertuples():
+		if region.parameter not in design.columns:
+			continue
+		x = design[region.parameter]
+		if region.low == region.high:
+			flagged |= x.astype(str) == str(region.low)
+		else:
+			flagged |= (x >= region.low) & (x <= region.high)
+	return flagged
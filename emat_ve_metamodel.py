@@ -0,0 +1,1010 @@
+import os
+import io
+import json
+import time
+import threading
+import hashlib
+import numpy as np
+import pandas as pd
+import logging
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import minimize
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+# The metamodel variables file is located in the same
+# directory as this script file.
+this_directory = os.path.dirname(__file__)
+
+
+def metamodel_variables(scope=None, filename=None):
+	"""
+	The list of performance measures to build metamodels for.
+
+	Args:
+		scope (emat.Scope, optional):
+			If given, variables that are not measures in this
+			scope are dropped (with a warning) from the list.
+		filename (str, optional):
+			The csv file listing the variables.  Defaults to the
+			*metamodel_variables.csv* file in this directory.
+
+	Returns:
+		list of str
+	"""
+	if filename is None:
+		filename = os.path.join(this_directory, 'metamodel_variables.csv')
+	variables = list(pd.read_csv(filename)['Variables'].dropna().astype(str).str.strip())
+	if scope is not None:
+		measure_names = set(scope.get_measure_names())
+		missing = [v for v in variables if v not in measure_names]
+		if missing:
+			_logger.warning(f"metamodel variables not in scope {scope.name}: {', '.join(missing)}")
+		variables = [v for v in variables if v in measure_names]
+	return variables
+
+
+class ScopeEncoder:
+	"""
+	Encode experiment parameters as unit-scaled numeric features.
+
+	Real and integer parameters are scaled to [0,1] using the scope
+	min and max, boolean parameters are cast to float, and categorical
+	parameters are one-hot encoded over the values defined in the scope.
+	Parameters with no range (min equal to max) are skipped.
+
+	Args:
+		scope (emat.Scope):
+			The scope defining the uncertainties and levers.
+	"""
+
+	def __init__(self, scope):
+		self.columns = []
+		for p in scope.get_uncertainties() + scope.get_levers():
+			if p.dtype == 'cat':
+				self.columns.append((p.name, 'cat', list(p.values)))
+			elif p.dtype == 'bool':
+				self.columns.append((p.name, 'bool', None))
+			elif p.max > p.min:
+				self.columns.append((p.name, 'real', (p.min, p.max - p.min)))
+
+	@property
+	def parameter_names(self):
+		"""list of str: The names of the encoded parameters."""
+		return [name for name, _, _ in self.columns]
+
+	@property
+	def feature_names(self):
+		"""list of str: The names of the encoded features."""
+		names = []
+		for name, kind, info in self.columns:
+			if kind == 'cat':
+				names.extend(f"{name}={v}" for v in info)
+			else:
+				names.append(name)
+		return names
+
+	def transform(self, df):
+		"""
+		Encode parameters as features.
+
+		Args:
+			df (pandas.DataFrame or Mapping):
+				Parameter values, with a column (or key) for each
+				encoded parameter.  Mapping values may be scalars
+				or arrays.
+
+		Returns:
+			numpy.ndarray: Features, with shape (n_rows, n_features).
+		"""
+		features = []
+		for name, kind, info in self.columns:
+			x = np.atleast_1d(np.asarray(df[name]))
+			if kind == 'cat':
+				features.extend((x == v).astype(np.float64) for v in info)
+			elif kind == 'bool':
+				features.append(x.astype(np.float64))
+			else:
+				lo, span = info
+				features.append((x.astype(np.float64) - lo) / span)
+		n = max(len(f) for f in features)
+		return np.column_stack([np.broadcast_to(f, (n,)) for f in features])
+
+
+class GaussianProcessMetamodel:
+	"""
+	A multi-output Gaussian process with a shared kernel.
+
+	Each output is standardized and detrended by a linear regression
+	on the features, and the residuals are modeled by a Gaussian process
+	with an anisotropic squared exponential correlation and a nugget.
+	The correlation hyperparameters are shared by all outputs and are
+	fit by maximizing the joint concentrated likelihood, so a single
+	Cholesky factorization serves every output; each output keeps its
+	own process variance.
+
+	Args:
+		nugget (float, default 1e-6):
+			Initial value for the nugget (relative noise variance).
+		optimize (bool, default True):
+			Whether to optimize the hyperparameters when fitting.
+		length_scales (array-like, optional):
+			Initial (or fixed, if `optimize` is False) length scales.
+		chunk_size (int, default 10000):
+			Number of rows predicted at once.
+		maxiter (int, optional):
+			Limit on optimizer iterations, useful when warm starting
+			from the hyperparameters of an earlier fit.
+	"""
+
+	_log_length_scale_bounds = (np.log(0.01), np.log(100.0))
+	_log_nugget_bounds = (np.log(1e-8), np.log(1e-1))
+
+	def __init__(self, nugget=1e-6, optimize=True, length_scales=None, chunk_size=10000, maxiter=None):
+		self.nugget = nugget
+		self.optimize = optimize
+		self.length_scales = None if length_scales is None else np.asarray(length_scales, dtype=np.float64)
+		self.chunk_size = chunk_size
+		self.maxiter = maxiter
+
+	def _correlation(self, A, B, length_scales):
+		A = A / length_scales
+		B = B / length_scales
+		sq = (A**2).sum(1)[:, None] + (B**2).sum(1)[None, :] - 2.0 * A @ B.T
+		return np.exp(-0.5 * np.maximum(sq, 0.0))
+
+	def _trend_basis(self, X):
+		return np.column_stack([np.ones(len(X)), X])
+
+	def _factor(self, length_scales, nugget):
+		R = self._correlation(self.X_, self.X_, length_scales)
+		R[np.diag_indices_from(R)] += nugget
+		return cho_factor(R, lower=True)
+
+	def _neg_log_likelihood(self, theta):
+		length_scales = np.exp(theta[:-1])
+		nugget = np.exp(theta[-1])
+		try:
+			c = self._factor(length_scales, nugget)
+		except np.linalg.LinAlgError:
+			return 1e25
+		n, m = self.residuals_.shape
+		sigma2 = (self.residuals_ * cho_solve(c, self.residuals_)).sum(0) / n
+		log_det = 2.0 * np.log(np.diag(c[0])).sum()
+		return 0.5 * n * np.log(np.maximum(sigma2, 1e-300)).sum() + 0.5 * m * log_det
+
+	def fit(self, X, Y):
+		"""
+		Fit the metamodel.
+
+		Args:
+			X (array-like): Features, shape (n_samples, n_features).
+			Y (array-like): Outputs, shape (n_samples, n_outputs).
+
+		Returns:
+			self
+
+		Raises:
+			ValueError: If there are no samples.
+		"""
+		self.X_ = np.asarray(X, dtype=np.float64)
+		if self.X_.shape[0] == 0:
+			raise ValueError("a metamodel cannot be fit to no samples")
+		Y = np.asarray(Y, dtype=np.float64)
+		if Y.ndim == 1:
+			Y = Y[:, None]
+		self.Y_ = Y
+		self.y_mean_ = Y.mean(0)
+		self.y_scale_ = Y.std(0)
+		self.y_scale_[self.y_scale_ == 0] = 1.0
+		Ys = (Y - self.y_mean_) / self.y_scale_
+
+		# Detrend with a lightly regularized linear regression.
+		H = self._trend_basis(self.X_)
+		ridge = 1e-8 * np.eye(H.shape[1])
+		self.beta_ = np.linalg.solve(H.T @ H + ridge, H.T @ Ys)
+		self.residuals_ = Ys - H @ self.beta_
+
+		n_features = self.X_.shape[1]
+		if self.length_scales is None:
+			length_scales = np.full(n_features, 0.5)
+		else:
+			length_scales = self.length_scales
+		theta0 = np.append(np.log(length_scales), np.log(self.nugget))
+		if self.optimize:
+			bounds = [self._log_length_scale_bounds] * n_features + [self._log_nugget_bounds]
+			options = {} if self.maxiter is None else {'maxiter': self.maxiter}
+			result = minimize(self._neg_log_likelihood, theta0, method='L-BFGS-B', bounds=bounds, options=options)
+			theta0 = result.x
+		self.length_scales = np.exp(theta0[:-1])
+		self.nugget = float(np.exp(theta0[-1]))
+		self._set_posterior()
+		return self
+
+	def _set_posterior(self):
+		self.chol_ = self._factor(self.length_scales, self.nugget)
+		self.alpha_ = cho_solve(self.chol_, self.residuals_)
+		self.sigma2_ = (self.residuals_ * self.alpha_).sum(0) / len(self.X_)
+
+	def _predict_chunk(self, X, return_std):
+		k = self._correlation(X, self.X_, self.length_scales)
+		mean = self._trend_basis(X) @ self.beta_ + k @ self.alpha_
+		mean = mean * self.y_scale_ + self.y_mean_
+		if not return_std:
+			return mean, None
+		v = solve_triangular(self.chol_[0], k.T, lower=True)
+		var = np.maximum(1.0 + self.nugget - (v**2).sum(0), 0.0)
+		std = np.sqrt(var[:, None] * self.sigma2_[None, :]) * self.y_scale_
+		return mean, std
+
+	def predict(self, X, return_std=False):
+		"""
+		Predict outputs.
+
+		Args:
+			X (array-like): Features, shape (n_samples, n_features).
+			return_std (bool, default False):
+				Also return the predictive standard deviation.
+
+		Returns:
+			numpy.ndarray or (numpy.ndarray, numpy.ndarray):
+				The predicted mean, shape (n_samples, n_outputs),
+				and optionally the standard deviation.
+		"""
+		X = np.asarray(X, dtype=np.float64)
+		means, stds = [], []
+		for start in range(0, len(X), self.chunk_size):
+			mean, std = self._predict_chunk(X[start:start + self.chunk_size], return_std)
+			means.append(mean)
+			stds.append(std)
+		mean = np.concatenate(means) if means else np.empty((0, len(self.y_mean_)))
+		if return_std:
+			std = np.concatenate(stds) if stds else np.empty((0, len(self.y_mean_)))
+			return mean, std
+		return mean
+
+	def update(self, X, Y):
+		"""
+		Add observations without refitting the hyperparameters.
+
+		The Cholesky factor is extended by the new rows (a rank-one
+		update per observation), keeping the standardization, trend and
+		kernel from the last fit, so an update costs O(n^2) rather than
+		the O(n^3) of a refit.
+
+		Args:
+			X (array-like): New features, shape (n_new, n_features).
+			Y (array-like): New outputs, shape (n_new, n_outputs).
+
+		Returns:
+			self
+		"""
+		X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+		Y = np.asarray(Y, dtype=np.float64)
+		if Y.ndim == 1:
+			Y = Y[:, None]
+		residuals = (Y - self.y_mean_) / self.y_scale_ - self._trend_basis(X) @ self.beta_
+
+		L = np.tril(self.chol_[0])
+		B = solve_triangular(L, self._correlation(self.X_, X, self.length_scales), lower=True)
+		R = self._correlation(X, X, self.length_scales)
+		R[np.diag_indices_from(R)] += self.nugget
+		C = np.linalg.cholesky(R - B.T @ B)
+		L = np.block([
+			[L, np.zeros((len(L), len(X)))],
+			[B.T, C],
+		])
+
+		self.X_ = np.vstack([self.X_, X])
+		self.Y_ = np.vstack([self.Y_, Y])
+		self.residuals_ = np.vstack([self.residuals_, residuals])
+		self.chol_ = (L, True)
+		self.alpha_ = cho_solve(self.chol_, self.residuals_)
+		self.sigma2_ = (self.residuals_ * self.alpha_).sum(0) / len(self.X_)
+		return self
+
+	def loo_residuals(self):
+		"""
+		Closed-form leave-one-out residuals of the fitted process.
+
+		Returns:
+			numpy.ndarray: Residuals in output units, shape (n_samples, n_outputs).
+		"""
+		n = len(self.X_)
+		inv_diag = np.diag(cho_solve(self.chol_, np.eye(n)))
+		return (self.alpha_ / inv_diag[:, None]) * self.y_scale_
+
+	def loo_relative_error(self):
+		"""
+		Leave-one-out root mean squared error relative to each output's spread.
+
+		Returns:
+			numpy.ndarray: One value per output.
+		"""
+		rmse = np.sqrt((self.loo_residuals()**2).mean(0))
+		spread = self.Y_.std(0)
+		spread[spread == 0] = 1.0
+		return rmse / spread
+
+	def select_batch(self, candidates, batch_size):
+		"""
+		Greedily pick the candidates that most reduce predictive uncertainty.
+
+		The posterior variance of a Gaussian process does not depend on
+		the output values, so each pick is added to the training points
+		as a hypothetical experiment before choosing the next, which
+		spreads the batch across the uncertain regions instead of
+		piling it onto a single peak.
+
+		Args:
+			candidates (array-like): Candidate features, shape (n_candidates, n_features).
+			batch_size (int): The number of candidates to pick.
+
+		Returns:
+			list of int: Row positions of the picked candidates.
+		"""
+		candidates = np.asarray(candidates, dtype=np.float64)
+		# Each pick extends the Cholesky factor by one row, which updates
+		# the candidates' variance by a rank-one term, so a pick costs
+		# O(n * n_candidates) rather than a refactorization.
+		V = solve_triangular(
+			np.tril(self.chol_[0]),
+			self._correlation(self.X_, candidates, self.length_scales),
+			lower=True,
+		)
+		var = 1.0 + self.nugget - (V**2).sum(0)
+		picked = np.zeros(len(candidates), dtype=bool)
+		picks = []
+		for _ in range(min(batch_size, len(candidates))):
+			best = int(np.argmax(np.where(picked, -np.inf, var)))
+			picks.append(best)
+			picked[best] = True
+			k = self._correlation(candidates, candidates[best:best + 1], self.length_scales)[:, 0]
+			w = (k - V.T @ V[:, best]) / np.sqrt(max(var[best], 1e-300))
+			V = np.vstack([V, w])
+			var = var - w**2
+		return picks
+
+
+def experiment_set_hash(experiment_ids, measure_names=(), values=None):
+	"""
+	A short hash identifying a set of experiments and measures.
+
+	Args:
+		experiment_ids (Collection[int]): The experiment ids.
+		measure_names (Collection[str], optional): The measure names.
+		values (array-like, optional): The measure values, a row per
+			experiment in the order of `experiment_ids`.  Including them
+			makes the hash change when experiments are re-run.
+
+	Returns:
+		str
+	"""
+	experiment_ids = np.asarray(experiment_ids).astype(np.int64)
+	order = np.argsort(experiment_ids, kind='stable')
+	h = hashlib.sha1()
+	h.update(",".join(str(i) for i in experiment_ids[order]).encode())
+	h.update(b"|")
+	h.update(",".join(measure_names).encode())
+	if values is not None:
+		h.update(b"|")
+		h.update(np.ascontiguousarray(np.asarray(values, dtype=np.float64)[order]).tobytes())
+	return h.hexdigest()[:16]
+
+
+# Output transforms by metamodeltype, as (forward, inverse, derivative of inverse).
+_output_transforms = {
+	'log': (np.log, np.exp, np.exp),
+	'log-linear': (np.log, np.exp, np.exp),
+	'ln': (np.log, np.exp, np.exp),
+	'log1p': (np.log1p, np.expm1, np.exp),
+	'log1p-linear': (np.log1p, np.expm1, np.exp),
+	'logit': (
+		lambda y: np.log(y / (1 - y)),
+		lambda z: 1 / (1 + np.exp(-z)),
+		lambda z: np.exp(-z) / (1 + np.exp(-z))**2,
+	),
+}
+
+# The values each output transform accepts.
+_transform_domains = {
+	'log': lambda y: y > 0,
+	'log-linear': lambda y: y > 0,
+	'ln': lambda y: y > 0,
+	'log1p': lambda y: y > -1,
+	'log1p-linear': lambda y: y > -1,
+	'logit': lambda y: (y > 0) & (y < 1),
+}
+
+
+class MetamodelEngine:
+	"""
+	Fit and predict metamodels for a batch of measures at once.
+
+	All measures share the scope's feature encoding and a single
+	Gaussian process kernel, so one fit covers every listed measure and
+	prediction is a handful of dense matrix products, evaluated in chunks.
+	Measures with a `metamodeltype` of log, log1p or logit in the scope are
+	fit on the transformed scale; any other type is treated as linear.
+
+	Args:
+		scope (emat.Scope):
+			The scope defining the inputs and measures.
+		measure_names (Collection[str], optional):
+			The measures to fit.  Defaults to the measures listed in
+			*metamodel_variables.csv* that are in the scope.
+	"""
+
+	def __init__(self, scope, measure_names=None):
+		self.scope_name = scope.name
+		self.encoder = ScopeEncoder(scope)
+		if measure_names is None:
+			measure_names = metamodel_variables(scope)
+		self.measure_names = list(measure_names)
+		metamodeltypes = {m.name: str(m.metamodeltype or 'linear').lower() for m in scope.get_measures()}
+		self.transforms = {
+			name: metamodeltypes.get(name)
+			for name in self.measure_names
+			if metamodeltypes.get(name) in _output_transforms
+		}
+		self.metamodel = None
+		self.experiment_ids = None
+		self.experiment_set = None
+
+	def _check_domains(self, Y):
+		"""
+		Fall back to linear for measures with values outside their transform's domain.
+
+		One value of zero for a log measure would make its outputs
+		infinite, and since the kernel likelihood is shared that would
+		spoil the fit of every measure.
+		"""
+		Y = np.asarray(Y, dtype=np.float64)
+		for j, name in enumerate(self.measure_names):
+			t = self.transforms.get(name)
+			if t is not None and not _transform_domains[t](Y[:, j]).all():
+				_logger.warning(f"METAMODEL {name} has values outside the domain of {t}, fitting it as linear")
+				del self.transforms[name]
+
+	def _forward(self, Y):
+		Y = np.array(Y, dtype=np.float64)
+		for j, name in enumerate(self.measure_names):
+			t = self.transforms.get(name)
+			if t is not None:
+				if not _transform_domains[t](Y[:, j]).all():
+					raise ValueError(f"{name} has values outside the domain of {t}")
+				Y[:, j] = _output_transforms[t][0](Y[:, j])
+		return Y
+
+	def _inverse(self, mean, std=None):
+		for j, name in enumerate(self.measure_names):
+			t = self.transforms.get(name)
+			if t is not None:
+				_, inverse, d_inverse = _output_transforms[t]
+				if std is not None:
+					std[:, j] = std[:, j] * d_inverse(mean[:, j])
+				mean[:, j] = inverse(mean[:, j])
+		return mean, std
+
+	def fit(self, experiments, warm_start=None):
+		"""
+		Fit the metamodel to completed experiments.
+
+		Experiments with any missing measure value (e.g. failed runs)
+		are dropped before fitting.  Measures with values outside the
+		domain of their transform are fit as linear.
+
+		Args:
+			experiments (pandas.DataFrame):
+				Experiment parameters and measures, indexed by experiment id.
+			warm_start (MetamodelEngine, optional):
+				An earlier fit whose kernel hyperparameters are used as the
+				starting point, with a short optimization.
+
+		Returns:
+			self
+
+		Raises:
+			ValueError: If no experiment has every measure.
+		"""
+		complete = experiments[self.measure_names].notnull().all(axis=1)
+		experiments = experiments.loc[complete]
+		if experiments.empty:
+			raise ValueError(f"no complete experiments to fit metamodels to for scope {self.scope_name}")
+		if warm_start is not None and warm_start.metamodel is not None:
+			metamodel = GaussianProcessMetamodel(
+				nugget=warm_start.metamodel.nugget,
+				length_scales=warm_start.metamodel.length_scales,
+				maxiter=20,
+			)
+		else:
+			metamodel = GaussianProcessMetamodel()
+		values = experiments[self.measure_names].to_numpy(dtype=np.float64)
+		self._check_domains(values)
+		self.metamodel = metamodel.fit(self.encoder.transform(experiments), self._forward(values))
+		self.experiment_ids = np.asarray(experiments.index.get_level_values(0))
+		self.experiment_values = values
+		self.experiment_set = experiment_set_hash(self.experiment_ids, self.measure_names, values)
+		return self
+
+	def update(self, experiments):
+		"""
+		Add completed experiments to the fit without refitting the kernel.
+
+		Experiments already in the fit, or with missing measures, are skipped.
+
+		Args:
+			experiments (pandas.DataFrame):
+				Experiment parameters and measures, indexed by experiment id.
+
+		Returns:
+			int: The number of experiments added.
+
+		Raises:
+			ValueError: If a new value is outside the domain of its
+				measure's transform; refit to fall back to linear.
+			numpy.linalg.LinAlgError: If a new experiment nearly
+				duplicates one in the fit; refit to include it.
+		"""
+		complete = experiments[self.measure_names].notnull().all(axis=1)
+		ids = experiments.index.get_level_values(0)
+		new = complete & ~np.isin(ids, self.experiment_ids)
+		if not new.any():
+			return 0
+		experiments = experiments.loc[new]
+		values = experiments[self.measure_names].to_numpy(dtype=np.float64)
+		self.metamodel.update(self.encoder.transform(experiments), self._forward(values))
+		self.experiment_ids = np.append(self.experiment_ids, experiments.index.get_level_values(0))
+		self.experiment_values = np.vstack([self.experiment_values, values])
+		self.experiment_set = experiment_set_hash(self.experiment_ids, self.measure_names, self.experiment_values)
+		return int(new.sum())
+
+	def predict_array(self, X, return_std=False):
+		"""
+		Predict measures from already encoded features.
+
+		Args:
+			X (numpy.ndarray): Features, as from `encoder.transform`.
+			return_std (bool, default False):
+				Also return the predictive standard deviation.
+
+		Returns:
+			numpy.ndarray or (numpy.ndarray, numpy.ndarray)
+		"""
+		if return_std:
+			mean, std = self.metamodel.predict(X, return_std=True)
+			return self._inverse(mean, std)
+		mean, _ = self._inverse(self.metamodel.predict(X))
+		return mean
+
+	def predict(self, design, return_std=False):
+		"""
+		Predict measures for a design of experiments.
+
+		Args:
+			design (pandas.DataFrame or Mapping):
+				Parameter values; mapping values may be arrays.
+			return_std (bool, default False):
+				Also return the predictive standard deviation.
+
+		Returns:
+			pandas.DataFrame or (pandas.DataFrame, pandas.DataFrame)
+		"""
+		index = getattr(design, 'index', None)
+		result = self.predict_array(self.encoder.transform(design), return_std=return_std)
+		if return_std:
+			mean, std = result
+			return (
+				pd.DataFrame(mean, index=index, columns=self.measure_names),
+				pd.DataFrame(std, index=index, columns=self.measure_names),
+			)
+		return pd.DataFrame(result, index=index, columns=self.measure_names)
+
+	def loo_relative_error(self):
+		"""
+		Leave-one-out error of each measure, relative to its spread.
+
+		Errors are computed on the fitted (possibly transformed) scale.
+
+		Returns:
+			pandas.Series
+		"""
+		return pd.Series(self.metamodel.loo_relative_error(), index=self.measure_names)
+
+
+# The arrays of a fitted GaussianProcessMetamodel, as stored in the cache.
+_metamodel_arrays = ('length_scales', 'X_', 'Y_', 'y_mean_', 'y_scale_', 'beta_', 'residuals_', 'alpha_', 'sigma2_')
+
+
+def engine_to_bytes(engine):
+	"""
+	Serialize a fitted MetamodelEngine as plain arrays.
+
+	The engine is written as a numpy .npz archive of numeric arrays plus
+	a JSON header, never as a pickle, so reading a cached engine from a
+	shared database cannot execute code.
+
+	Args:
+		engine (MetamodelEngine): A fitted engine.
+
+	Returns:
+		bytes
+	"""
+	gp = engine.metamodel
+	header = {
+		'scope_name': engine.scope_name,
+		'measure_names': engine.measure_names,
+		'transforms': engine.transforms,
+		'columns': [(name, kind, info if info is None else list(info)) for name, kind, info in engine.encoder.columns],
+		'experiment_set': engine.experiment_set,
+		'nugget': gp.nugget,
+		'optimize': gp.optimize,
+		'chunk_size': gp.chunk_size,
+		'maxiter': gp.maxiter,
+	}
+	arrays = {name: getattr(gp, name) for name in _metamodel_arrays}
+	arrays['chol_'] = gp.chol_[0]
+	arrays['experiment_ids'] = np.asarray(engine.experiment_ids, dtype=np.int64)
+	arrays['experiment_values'] = engine.experiment_values
+	buffer = io.BytesIO()
+	np.savez_compressed(buffer, header=np.array(json.dumps(header, default=lambda o: o.item())), **arrays)
+	return buffer.getvalue()
+
+
+def engine_from_bytes(data):
+	"""
+	Read a MetamodelEngine written by `engine_to_bytes`.
+
+	Args:
+		data (bytes)
+
+	Returns:
+		MetamodelEngine
+	"""
+	with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+		header = json.loads(str(arrays['header']))
+		gp = GaussianProcessMetamodel(
+			nugget=header['nugget'],
+			optimize=header['optimize'],
+			chunk_size=header['chunk_size'],
+			maxiter=header['maxiter'],
+		)
+		for name in _metamodel_arrays:
+			setattr(gp, name, arrays[name])
+		gp.chol_ = (arrays['chol_'], True)
+		engine = MetamodelEngine.__new__(MetamodelEngine)
+		engine.encoder = ScopeEncoder.__new__(ScopeEncoder)
+		engine.encoder.columns = [
+			(name, kind, info if kind != 'real' else tuple(info))
+			for name, kind, info in header['columns']
+		]
+		engine.scope_name = header['scope_name']
+		engine.measure_names = header['measure_names']
+		engine.transforms = header['transforms']
+		engine.experiment_set = header['experiment_set']
+		engine.experiment_ids = arrays['experiment_ids']
+		engine.experiment_values = arrays['experiment_values']
+		engine.metamodel = gp
+	return engine
+
+
+_CREATE_METAMODEL_CACHE = """
+CREATE TABLE IF NOT EXISTS ve_metamodel_cache (
+	scope_name TEXT NOT NULL,
+	experiment_set TEXT NOT NULL,
+	version INTEGER NOT NULL,
+	n_experiments INTEGER,
+	measures TEXT,
+	created REAL,
+	engine BLOB,
+	PRIMARY KEY (scope_name, experiment_set)
+)
+"""
+
+
+def store_metamodel(db, engine):
+	"""
+	Store a fitted MetamodelEngine in the EMAT database.
+
+	Each stored engine gets the next version number for its scope.
+
+	Args:
+		db (emat.SQLiteDB): The database.
+		engine (MetamodelEngine): A fitted engine.
+
+	Returns:
+		int: The version number.
+
+	Raises:
+		ValueError: If the engine was fit to no experiments.
+	"""
+	if engine.metamodel is None or len(engine.experiment_ids) == 0:
+		raise ValueError(f"not caching a metamodel with no experiments for scope {engine.scope_name}")
+	with db.conn:
+		db.conn.execute(_CREATE_METAMODEL_CACHE)
+		row = db.conn.execute(
+			"SELECT version FROM ve_metamodel_cache WHERE scope_name=? AND experiment_set=?",
+			(engine.scope_name, engine.experiment_set),
+		).fetchone()
+		if row is not None:
+			return row[0]
+		version = db.conn.execute(
+			"SELECT COALESCE(MAX(version), 0) + 1 FROM ve_metamodel_cache WHERE scope_name=?",
+			(engine.scope_name,),
+		).fetchone()[0]
+		db.conn.execute(
+			"INSERT INTO ve_metamodel_cache VALUES (?,?,?,?,?,?,?)",
+			(
+				engine.scope_name,
+				engine.experiment_set,
+				version,
+				len(engine.experiment_ids),
+				",".join(engine.measure_names),
+				time.time(),
+				engine_to_bytes(engine),
+			),
+		)
+	return version
+
+
+def read_metamodel(db, scope_name, experiment_set=None, version=None):
+	"""
+	Read a cached MetamodelEngine from the EMAT database.
+
+	Args:
+		db (emat.SQLiteDB): The database.
+		scope_name (str): The scope name.
+		experiment_set (str, optional): The experiment set hash to read.
+		version (int, optional): The version to read.  If neither this
+			nor `experiment_set` is given, the latest version is read.
+
+	Returns:
+		MetamodelEngine or None: None if no matching engine is cached.
+	"""
+	exists = db.conn.execute(
+		"SELECT name FROM sqlite_master WHERE type='table' AND name='ve_metamodel_cache'"
+	).fetchone()
+	if exists is None:
+		return None
+	qry = "SELECT engine FROM ve_metamodel_cache WHERE scope_name=?"
+	bindings = [scope_name]
+	if experiment_set is not None:
+		qry += " AND experiment_set=?"
+		bindings.append(experiment_set)
+	if version is not None:
+		qry += " AND version=?"
+		bindings.append(version)
+	row = db.conn.execute(qry + " ORDER BY version DESC LIMIT 1", bindings).fetchone()
+	if row is None:
+		return None
+	try:
+		return engine_from_bytes(row[0])
+	except (ValueError, OSError, KeyError) as err:
+		# e.g. an engine cached as a pickle by an earlier version, which is not read
+		_logger.warning(f"METAMODEL cached engine for {scope_name} is unreadable, ignoring it: {err}")
+		return None
+
+
+def fit_metamodels(db, scope, design_name=None, measure_names=None):
+	"""
+	Fit (or load from cache) metamodels for all listed measures.
+
+	If an engine for exactly this experiment set is cached in the database
+	it is returned directly.  Otherwise a new engine is fit, warm started
+	from the latest cached version for the scope when the measures match,
+	so that refits as new experiments land are quick.  The new engine is
+	stored as the next version.
+
+	Args:
+		db (emat.SQLiteDB): The database holding the experiments.
+		scope (emat.Scope): The scope.
+		design_name (str or Collection[str], optional): Limit the
+			experiments to these designs.
+		measure_names (Collection[str], optional): The measures to fit.
+			Defaults to the *metamodel_variables.csv* measures.
+
+	Returns:
+		MetamodelEngine
+
+	Raises:
+		ValueError: If no experiment has every measure.
+	"""
+	engine = MetamodelEngine(scope, measure_names)
+	experiments = db.read_experiment_all(scope.name, design_name, only_with_measures=True)
+	complete = experiments[engine.measure_names].notnull().all(axis=1)
+	if not complete.any():
+		raise ValueError(f"no complete experiments to fit metamodels to for scope {scope.name}")
+	experiment_set = experiment_set_hash(
+		experiments.index[complete].get_level_values(0),
+		engine.measure_names,
+		experiments.loc[complete, engine.measure_names],
+	)
+	cached = read_metamodel(db, scope.name, experiment_set=experiment_set)
+	if cached is not None:
+		_logger.info(f"METAMODEL cache hit for {scope.name} [{experiment_set}]")
+		return cached
+	previous = read_metamodel(db, scope.name)
+	if previous is not None and previous.measure_names != engine.measure_names:
+		previous = None
+	engine.fit(experiments, warm_start=previous)
+	version = store_metamodel(db, engine)
+	_logger.info(
+		f"METAMODEL fit {scope.name} [{engine.experiment_set}] version {version} "
+		f"on {len(engine.experiment_ids)} experiments"
+	)
+	return engine
+
+
+class MetamodelService:
+	"""
+	Keep metamodels current while experiments stream into the database.
+
+	A background thread polls the EMAT database for newly stored
+	experiment measures.  Each new experiment is added to the fitted
+	metamodel with a rank-one update, and after every `refit_every`
+	added experiments the kernel hyperparameters are refit, warm started
+	from the current values.  Predictions and error estimates are
+	available at any time, reflecting all experiments received so far.
+
+	The service thread opens its own read-only connection to the
+	database, so it does not contend with the connection used to run
+	experiments.
+
+	Args:
+		database_path (str): Path to the EMAT SQLite database file.
+		scope (emat.Scope): The scope.
+		measure_names (Collection[str], optional): The measures to fit.
+			Defaults to the *metamodel_variables.csv* measures.
+		poll_interval (float, default 5.0): Seconds between polls.
+		refit_every (int, default 25): Number of updates between
+			hyperparameter refits.
+		min_experiments (int, optional): Number of completed experiments
+			required before the first fit.  Defaults to one more than the
+			number of encoded features.
+	"""
+
+	def __init__(
+			self,
+			database_path,
+			scope,
+			measure_names=None,
+			poll_interval=5.0,
+			refit_every=25,
+			min_experiments=None,
+	):
+		self.database_path = database_path
+		self.scope = scope
+		self.engine = MetamodelEngine(scope, measure_names)
+		self.poll_interval = poll_interval
+		self.refit_every = refit_every
+		if min_experiments is None:
+			min_experiments = len(self.engine.encoder.feature_names) + 1
+		self.min_experiments = min_experiments
+		self._updates_since_fit = 0
+		self._last_count = None
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		"""Start polling in a background thread."""
+		if self._thread is not None and self._thread.is_alive():
+			return self
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._serve, name="MetamodelService", daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""Stop polling and wait for the background thread to finish."""
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def _serve(self):
+		from emat import SQLiteDB
+		db = SQLiteDB(self.database_path, readonly=True, check_same_thread=False)
+		cached = read_metamodel(db, self.scope.name)
+		if cached is not None and cached.measure_names == self.engine.measure_names:
+			self.engine = cached
+		while not self._stop.is_set():
+			try:
+				self.poll(db)
+			except Exception:
+				_logger.exception("METAMODEL SERVICE poll failed")
+			self._stop.wait(self.poll_interval)
+
+	def poll(self, db):
+		"""
+		Check the database once and fold in any new experiments.
+
+		Args:
+			db (emat.SQLiteDB): The database to read.
+
+		Returns:
+			int: The number of experiments added.
+		"""
+		count = db.conn.execute("SELECT COUNT(*) FROM ema_experiment_measure").fetchone()[0]
+		if count == self._last_count:
+			return 0
+		experiments = db.read_experiment_all(self.scope.name, only_with_measures=True)
+
+		# The count is only marked as seen once the new experiments are
+		# in the fit, so a failed poll is retried rather than skipped.
+		if self.engine.metamodel is None:
+			complete = experiments[self.engine.measure_names].notnull().all(axis=1)
+			if complete.sum() < max(self.min_experiments, 1):
+				self._last_count = count
+				return 0
+			engine = MetamodelEngine(self.scope, self.engine.measure_names).fit(experiments)
+			with self._lock:
+				self.engine = engine
+			self._updates_since_fit = 0
+			self._last_count = count
+			_logger.info(f"METAMODEL SERVICE initial fit on {len(engine.experiment_ids)} experiments")
+			return len(engine.experiment_ids)
+
+		n_before = len(self.engine.experiment_ids)
+		refit = False
+		try:
+			with self._lock:
+				n_added = self.engine.update(experiments)
+		except (np.linalg.LinAlgError, ValueError) as err:
+			# A near-duplicate experiment (the Cholesky extension is not
+			# positive definite) or a value outside a measure's transform
+			# domain; a full refit handles both.
+			_logger.warning(f"METAMODEL SERVICE update failed, refitting: {err}")
+			refit = True
+		else:
+			self._updates_since_fit += n_added
+			refit = n_added and self._updates_since_fit >= self.refit_every
+		if refit:
+			engine = MetamodelEngine(self.scope, self.engine.measure_names)
+			engine.fit(experiments, warm_start=self.engine)
+			n_added = len(engine.experiment_ids) - n_before
+			with self._lock:
+				self.engine = engine
+			self._updates_since_fit = 0
+			_logger.info(f"METAMODEL SERVICE refit on {len(engine.experiment_ids)} experiments")
+		elif n_added:
+			_logger.info(f"METAMODEL SERVICE added {n_added} experiments")
+		self._last_count = count
+		return n_added
+
+	@property
+	def n_experiments(self):
+		"""int: The number of experiments in the current fit."""
+		with self._lock:
+			if self.engine.metamodel is None:
+				return 0
+			return len(self.engine.experiment_ids)
+
+	def predict(self, design, return_std=True):
+		"""
+		Predict measures using the current metamodel.
+
+		Args:
+			design (pandas.DataFrame or Mapping): Parameter values.
+			return_std (bool, default True): Also return the
+				predictive standard deviation.
+
+		Returns:
+			pandas.DataFrame or (pandas.DataFrame, pandas.DataFrame)
+		"""
+		with self._lock:
+			if self.engine.metamodel is None:
+				raise ValueError("no metamodel fitted yet")
+			return self.engine.predict(design, return_std=return_std)
+
+	def errors(self):
+		"""
+		Current leave-one-out error estimates for each measure.
+
+		Returns:
+			pandas.Series
+		"""
+		with self._lock:
+			if self.engine.metamodel is None:
+				raise ValueError("no metamodel fitted yet")
+			return self.engine.loo_relative_error()
@@ -0,0 +1,393 @@
+import io
+import time
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import logging
+
+from emat_ve_screening import unit_features
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+_CREATE_OPTIMIZATION_CACHE = """
+CREATE TABLE IF NOT EXISTS ve_optimization_cache (
+	scope_name TEXT NOT NULL,
+	experiment_set TEXT NOT NULL,
+	settings TEXT NOT NULL,
+	created REAL,
+	evaluations BLOB,
+	PRIMARY KEY (scope_name, experiment_set, settings)
+)
+"""
+
+
+class RobustOptimizer:
+	"""
+	Search the policy levers for robust performance using a metamodel.
+
+	Each candidate lever setting is evaluated against a fixed sample of
+	scenarios over the exogenous uncertainties.  A whole population of
+	candidates is evaluated with one metamodel prediction over every
+	candidate and scenario pair, and each objective is summarized across
+	the scenarios by its mean or by a lower quantile of performance.
+	Candidates are scored by the weighted sum of their summarized
+	objectives, each scaled by the spread of the measure.  Scenarios are
+	drawn from the distribution of each uncertainty in the scope.
+
+	Every evaluation is cached by candidate, on a grid of `resolution` in
+	the unit range of each lever, and the cache can be stored in the
+	database, keyed by the metamodel's experiment set and the settings
+	here, so repeated searches only evaluate new candidates.
+
+	Args:
+		engine (MetamodelEngine): A fitted engine.
+		scope (emat.Scope): The scope of the engine.
+		objectives (Mapping[str,str], optional): 'max' or 'min' for each
+			measure to optimize.  Defaults to the engine's measures whose
+			scope `kind` is maximize or minimize.
+		weights (Mapping[str,float], optional): Weights of the objectives,
+			all 1 by default.
+		robustness (str, default 'mean'): 'mean' to average performance
+			over the scenarios, or 'quantile' to use the `quantile` of
+			performance (the worse tail).
+		quantile (float, default 0.1): The quantile used for 'quantile'.
+		n_scenarios (int, default 200): The number of uncertainty scenarios.
+		resolution (float, default 1e-3): The cache grid in unit lever range.
+		random_seed (int, default 0): Seed for scenarios and the search.
+	"""
+
+	def __init__(
+			self,
+			engine,
+			scope,
+			objectives=None,
+			weights=None,
+			robustness='mean',
+			quantile=0.1,
+			n_scenarios=200,
+			resolution=1e-3,
+			random_seed=0,
+	):
+		if robustness not in ('mean', 'quantile'):
+			raise ValueError(f"robustness must be mean or quantile, not {robustness}")
+		self.engine = engine
+		self.scope_name = scope.name
+		if objectives is None:
+			kinds = {m.name: m.kind for m in scope.get_measures()}
+			objectives = {
+				name: 'max' if kinds.get(name) == 1 else 'min'
+				for name in engine.measure_names
+				if kinds.get(name) in (1, -1)
+			}
+		if not objectives:
+			raise ValueError("no objectives given, and no metamodel measures are to be maximized or minimized")
+		missing = [name for name in objectives if name not in engine.measure_names]
+		if missing:
+			raise KeyError(f"objectives not in the metamodel: {', '.join(missing)}")
+		self.objectives = dict(objectives)
+		self.weights = {name: 1.0 for name in self.objectives}
+		self.weights.update(weights or {})
+		self.robustness = robustness
+		self.quantile = quantile
+		self.resolution = resolution
+		self.rng = np.random.default_rng(random_seed)
+
+		lever_names = {p.name for p in scope.get_levers()}
+		self._int_names = {p.name for p in scope.get_parameters() if p.dtype == 'int'}
+		columns = engine.encoder.columns
+		self._lever_j = [j for j, (name, _, _) in enumerate(columns) if name in lever_names]
+		self._scenario_j = [j for j, (name, _, _) in enumerate(columns) if name not in lever_names]
+		self.lever_names = [columns[j][0] for j in self._lever_j]
+		self.scenarios = self._draw_scenarios(scope, n_scenarios)
+
+		# Constants, and parameters the metamodel does not vary, for the
+		# confirmation runs.
+		encoded = set(engine.encoder.parameter_names)
+		self._fixed = {c.name: c.value for c in scope.get_constants()}
+		self._fixed.update({
+			p.name: p.min if p.default is None else p.default
+			for p in scope.get_parameters()
+			if p.name not in encoded
+		})
+
+		j = [engine.measure_names.index(name) for name in self.objectives]
+		self._objective_j = np.array(j)
+		self._sign = np.array([1.0 if d == 'max' else -1.0 for d in self.objectives.values()])
+		self._weight = np.array([self.weights[name] for name in self.objectives])
+		training, _ = engine._inverse(np.array(engine.metamodel.Y_), None)
+		spread = training[:, self._objective_j].std(0)
+		spread[spread == 0] = 1.0
+		self._spread = spread
+
+		self.settings = hashlib.sha1(json.dumps([
+			self.objectives, self.weights, robustness, quantile, n_scenarios, resolution, random_seed,
+		], sort_keys=True).encode()).hexdigest()[:16]
+		self._cache = {}
+
+	def _draw_scenarios(self, scope, n_scenarios):
+		"""
+		Unit coordinates of scenarios drawn from the scope's distributions.
+
+		Uniform draws are mapped through the quantile function of each
+		uncertainty's `dist`, then scaled to the unit coordinates of
+		`unit_features`.
+		"""
+		dists = {p.name: getattr(p, 'dist', None) for p in scope.get_parameters()}
+		U = self.rng.random((n_scenarios, len(self._scenario_j)))
+		for k, j in enumerate(self._scenario_j):
+			name, kind, info = self.engine.encoder.columns[j]
+			if dists.get(name) is None:
+				continue
+			x = dists[name].ppf(U[:, k])
+			if kind == 'cat':
+				# The dist is over the category index; take the middle of its slice.
+				U[:, k] = (np.clip(x, 0, len(info) - 1) + 0.5) / len(info)
+			elif kind == 'bool':
+				U[:, k] = x >= 0.5
+			else:
+				lo, span = info
+				U[:, k] = np.clip((x - lo) / span, 0, 1)
+		return U
+
+	def load(self, db):
+		"""Add cached evaluations from the database, if any."""
+		exists = db.conn.execute(
+			"SELECT name FROM sqlite_master WHERE type='table' AND name='ve_optimization_cache'"
+		).fetchone()
+		if exists is None:
+			return self
+		row = db.conn.execute(
+			"SELECT evaluations FROM ve_optimization_cache WHERE scope_name=? AND experiment_set=? AND settings=?",
+			(self.scope_name, self.engine.experiment_set, self.settings),
+		).fetchone()
+		if row is not None:
+			try:
+				self._cache.update(self._cache_from_bytes(row[0]))
+			except (ValueError, OSError, KeyError) as err:
+				# e.g. evaluations pickled by an earlier version, which are not read
+				_logger.warning(f"OPTIMIZE cached evaluations for {self.scope_name} are unreadable, ignoring them: {err}")
+			else:
+				_logger.info(f"OPTIMIZE loaded {len(self._cache)} cached evaluations")
+		return self
+
+	def store(self, db):
+		"""Store all evaluations so far in the database."""
+		if db.readonly:
+			return
+		with db.conn:
+			db.conn.execute(_CREATE_OPTIMIZATION_CACHE)
+			db.conn.execute(
+				"INSERT OR REPLACE INTO ve_optimization_cache VALUES (?,?,?,?,?)",
+				(
+					self.scope_name, self.engine.experiment_set, self.settings,
+					time.time(), self._cache_to_bytes(),
+				),
+			)
+
+	def _cache_to_bytes(self):
+		"""
+		The cached evaluations as an npz archive with a JSON header.
+
+		Like the metamodel cache, never a pickle, so reading evaluations
+		from a shared database cannot execute code.
+		"""
+		keys = list(self._cache)
+		codes = np.array([np.frombuffer(key, dtype=np.int64) for key in keys]).reshape(len(keys), len(self._lever_j))
+		values = np.array([self._cache[key] for key in keys]).reshape(len(keys), len(self.objectives) + 2)
+		header = {'lever_names': self.lever_names, 'objectives': list(self.objectives)}
+		buffer = io.BytesIO()
+		np.savez_compressed(buffer, header=np.array(json.dumps(header)), codes=codes, values=values)
+		return buffer.getvalue()
+
+	def _cache_from_bytes(self, data):
+		with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+			header = json.loads(str(arrays['header']))
+			if header['lever_names'] != self.lever_names or header['objectives'] != list(self.objectives):
+				raise ValueError("cached evaluations are for other levers or objectives")
+			codes = arrays['codes'].astype(np.int64)
+			values = arrays['values'].astype(np.float64)
+		return {code.tobytes(): row for code, row in zip(codes, values)}
+
+	def _full_points(self, levers, scenarios):
+		n, s = len(levers), len(scenarios)
+		U = np.empty((n * s, len(self.engine.encoder.columns)))
+		U[:, self._lever_j] = np.repeat(levers, s, axis=0)
+		U[:, self._scenario_j] = np.tile(scenarios, (n, 1))
+		return U
+
+	def evaluate(self, levers, chunk_size=64):
+		"""
+		Evaluate candidate lever settings, using the cache where possible.
+
+		Args:
+			levers (numpy.ndarray): Unit lever coordinates, shape
+				(n_candidates, n_levers) in the order of `lever_names`.
+			chunk_size (int, default 64): Candidates predicted at once.
+
+		Returns:
+			numpy.ndarray: For each candidate, the summarized value of each
+			objective (in measure units), then the score and the relative
+			uncertainty, shape (n_candidates, n_objectives + 2).
+		"""
+		codes = np.round(np.clip(levers, 0, 1) / self.resolution).astype(np.int64)
+		keys = [row.tobytes() for row in codes]
+		new = [i for i, key in enumerate(keys) if key not in self._cache]
+		new_keys = list(dict.fromkeys(keys[i] for i in new))
+		new_levers = np.array([np.frombuffer(key, dtype=np.int64) for key in new_keys]) * self.resolution
+		s = len(self.scenarios)
+		for start in range(0, len(new_keys), chunk_size):
+			chunk = new_levers[start:start + chunk_size]
+			X = unit_features(self.engine.encoder, self._full_points(chunk, self.scenarios))
+			mean, std = self.engine.predict_array(X, return_std=True)
+			mean = mean[:, self._objective_j].reshape(len(chunk), s, -1) * self._sign
+			std = std[:, self._objective_j].reshape(len(chunk), s, -1)
+			if self.robustness == 'mean':
+				summary = mean.mean(1)
+			else:
+				summary = np.quantile(mean, self.quantile, axis=1)
+			score = (self._weight * summary / self._spread).sum(1)
+			uncertainty = (std / self._spread).mean(axis=(1, 2))
+			values = np.column_stack([summary * self._sign, score, uncertainty])
+			for key, row in zip(new_keys[start:start + chunk_size], values):
+				self._cache[key] = row
+		return np.array([self._cache[key] for key in keys])
+
+	def _decode(self, U, columns):
+		values = {}
+		for k, j in enumerate(columns):
+			name, kind, info = self.engine.encoder.columns[j]
+			u = U[:, k]
+			if kind == 'cat':
+				values[name] = np.asarray(info, dtype=object)[np.minimum((u * len(info)).astype(int), len(info) - 1)]
+			elif kind == 'bool':
+				values[name] = u >= 0.5
+			else:
+				lo, span = info
+				values[name] = lo + u * span
+				if name in self._int_names:
+					values[name] = np.round(values[name]).astype(int)
+		return pd.DataFrame(values)
+
+	def decode(self, levers):
+		"""
+		Lever values for unit lever coordinates.
+
+		Returns:
+			pandas.DataFrame: A column per lever.
+		"""
+		return self._decode(levers, self._lever_j)
+
+	def search(self, population=256, generations=30, elite=32, mutation=0.1, immigrants=0.1):
+		"""
+		Evolve lever settings toward the best robust score.
+
+		Each generation keeps the `elite` best candidates found so far and
+		fills the rest of the population with Gaussian mutations of them,
+		plus a share of new random candidates.
+
+		Args:
+			population (int, default 256): Candidates per generation.
+			generations (int, default 30): The number of generations.
+			elite (int, default 32): Candidates kept as parents.
+			mutation (float, default 0.1): Standard deviation of mutations,
+				in unit lever range.
+			immigrants (float, default 0.1): Share of random candidates.
+
+		Returns:
+			pandas.DataFrame: Every candidate evaluated in the search, best
+			first, with the lever values, the summarized objectives, the
+			'score' and the relative 'uncertainty' of the predictions.
+		"""
+		k = len(self._lever_j)
+		levers = self.rng.random((population, k))
+		evaluated = {}
+		for generation in range(generations + 1):
+			values = self.evaluate(levers)
+			codes = np.round(np.clip(levers, 0, 1) / self.resolution).astype(np.int64)
+			for code, row in zip(codes, values):
+				evaluated[code.tobytes()] = row
+			if generation == generations:
+				break
+			keys = list(evaluated)
+			scores = np.array([evaluated[key][-2] for key in keys])
+			best = np.argsort(-scores)[:elite]
+			parents = np.array([np.frombuffer(keys[i], dtype=np.int64) for i in best]) * self.resolution
+			n_random = int(population * immigrants)
+			children = parents[self.rng.integers(0, len(parents), population - n_random)]
+			children = np.clip(children + self.rng.normal(0, mutation, children.shape), 0, 1)
+			levers = np.vstack([children, self.rng.random((n_random, k))])
+
+		keys = list(evaluated)
+		levers = np.array([np.frombuffer(key, dtype=np.int64) for key in keys]) * self.resolution
+		result = self.decode(levers)
+		values = np.array([evaluated[key] for key in keys])
+		for i, name in enumerate(self.objectives):
+			result[name] = values[:, i]
+		result['score'] = values[:, -2]
+		result['uncertainty'] = values[:, -1]
+		result['_levers_'] = list(levers)
+		result = result.sort_values('score', ascending=False).reset_index(drop=True)
+		_logger.info(
+			f"OPTIMIZE {len(result)} candidates, best score {result['score'].iloc[0]:.4f}, "
+			f"{len(self._cache)} evaluations cached"
+		)
+		return result
+
+	def confirmation_design(
+			self,
+			results,
+			top_k=4,
+			uncertainty_threshold=0.05,
+			n_scenarios=4,
+			pool=None,
+			min_distance=0.05,
+	):
+		"""
+		A design of VE runs to confirm the best uncertain candidates.
+
+		Of the best `pool` candidates, the top `top_k` whose relative
+		uncertainty exceeds `uncertainty_threshold`, and which are not
+		within `min_distance` of a better pick, are each paired with
+		`n_scenarios` of the uncertainty scenarios.
+
+		Args:
+			results (pandas.DataFrame): Results from `search`.
+			top_k (int, default 4): Candidates to confirm.
+			uncertainty_threshold (float, default 0.05): Only candidates
+				more uncertain than this are confirmed.
+			n_scenarios (int, default 4): Scenarios per candidate.
+			pool (int, optional): The number of best candidates to pick
+				from, by default four times `top_k`.
+			min_distance (float, default 0.05): The smallest distance
+				between picks, in unit lever range, so near duplicates of
+				one candidate are not all confirmed.
+
+		Returns:
+			pandas.DataFrame: Parameter values, one row per VE run, with
+			the scope's constants, the defaults of parameters the metamodel
+			does not vary, and the candidate's rank in results as
+			'_candidate_'.
+		"""
+		if pool is None:
+			pool = 4 * top_k
+		best = results.iloc[:pool]
+		best = best.loc[best['uncertainty'] > uncertainty_threshold]
+		picks = []
+		for i, candidate in zip(best.index, best['_levers_']):
+			if all(np.abs(candidate - results.at[j, '_levers_']).max() >= min_distance for j in picks):
+				picks.append(i)
+			if len(picks) == top_k:
+				break
+		if not picks:
+			return pd.DataFrame()
+		picks = results.loc[picks]
+		levers = np.array(list(picks['_levers_']))
+		scenarios = self.scenarios[:n_scenarios]
+		U = self._full_points(levers, scenarios)
+		design = self._decode(U, range(U.shape[1]))
+		for name, value in self._fixed.items():
+			design[name] = value
+		design['_candidate_'] = np.repeat(picks.index.to_numpy(), len(scenarios))
+		return design
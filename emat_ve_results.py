@@ -0,0 +1,154 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import logging
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+def _require_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+	except ImportError:
+		raise ImportError("columnar result export requires pyarrow (conda install pyarrow)") from None
+	return pyarrow
+
+
+def scope_partition(directory, scope_name):
+	"""The directory holding the exported results for one scope."""
+	return os.path.join(directory, f"scope={scope_name}")
+
+
+def export_experiments(db, scope, directory, design_name=None):
+	"""
+	Export experiment inputs and measures to a columnar store.
+
+	Experiments are written as a Parquet dataset partitioned by scope
+	(one `scope=<name>` directory per scope), replacing any earlier
+	export for the same scope.  The measures are also written as a
+	float64 results cube, stored measure by measure (Fortran order),
+	which `ResultsCube` memory-maps.
+
+	Args:
+		db (emat.SQLiteDB): The database holding the experiments.
+		scope (emat.Scope or str): The scope, or its name.
+		directory (str): The root directory of the columnar store.
+		design_name (str or Collection[str], optional): Limit the
+			export to these designs.
+
+	Returns:
+		str: The partition directory written.
+	"""
+	pa = _require_pyarrow()
+	scope_name = getattr(scope, 'name', scope)
+	if isinstance(scope, str):
+		scope = db.read_scope(scope_name)
+	experiments = db.read_experiment_all(scope_name, design_name)
+
+	partition = scope_partition(directory, scope_name)
+	os.makedirs(partition, exist_ok=True)
+	for i in os.scandir(partition):
+		if i.is_file():
+			os.remove(i.path)
+
+	table = pa.Table.from_pandas(experiments.reset_index(), preserve_index=False)
+	pa.parquet.write_table(table, os.path.join(partition, "experiments.parquet"))
+
+	measure_names = [m for m in scope.get_measure_names() if m in experiments.columns]
+	cube = experiments[measure_names].to_numpy(dtype=np.float64)
+	# Column-major, so each measure is one contiguous run of the file.
+	np.save(os.path.join(partition, "_cube.npy"), np.asfortranarray(cube))
+	np.save(
+		os.path.join(partition, "_cube_experiments.npy"),
+		np.asarray(experiments.index.get_level_values(0), dtype=np.int64),
+	)
+	with open(os.path.join(partition, "_cube.json"), 'wt') as f:
+		json.dump({'scope': scope_name, 'measures': measure_names}, f)
+
+	_logger.info(f"EXPORT {len(experiments)} experiments of {scope_name} to {partition}")
+	return partition
+
+
+def read_experiments(directory, scope_name=None, columns=None, filters=None):
+	"""
+	Read exported experiments with column projection and predicate pushdown.
+
+	Args:
+		directory (str): The root directory of the columnar store.
+		scope_name (str, optional): Read only this scope's partition.
+			If not given all scopes are read, with a `scope` column.
+		columns (Collection[str], optional): The columns to read.
+			The `experiment` id column is always included.
+		filters (list, optional): Row filters in the pyarrow
+			disjunctive normal form, e.g. `[('TAXSCEN', '>', 0.5)]`,
+			applied while reading so non-matching row groups are skipped.
+
+	Returns:
+		pandas.DataFrame: Indexed by experiment id.
+	"""
+	pa = _require_pyarrow()
+	if scope_name is not None:
+		path = scope_partition(directory, scope_name)
+	else:
+		path = directory
+	if columns is not None:
+		columns = ['experiment'] + [c for c in columns if c != 'experiment']
+	table = pa.parquet.read_table(path, columns=columns, filters=filters)
+	return table.to_pandas().set_index('experiment')
+
+
+class ResultsCube:
+	"""
+	A memory-mapped experiments-by-measures array of exported results.
+
+	The array is not read into memory; slices are paged in from disk
+	only as they are used, so plots and metamodel fitting can work from
+	`values` (or `column`) without copying the whole cube.
+
+	Args:
+		directory (str): The root directory of the columnar store.
+		scope_name (str): The scope to open.
+	"""
+
+	def __init__(self, directory, scope_name):
+		partition = scope_partition(directory, scope_name)
+		with open(os.path.join(partition, "_cube.json"), 'rt') as f:
+			meta = json.load(f)
+		self.scope_name = meta['scope']
+		self.measure_names = meta['measures']
+		self._measure_index = {name: j for j, name in enumerate(self.measure_names)}
+		self.values = np.load(os.path.join(partition, "_cube.npy"), mmap_mode='r')
+		self.experiment_ids = np.load(os.path.join(partition, "_cube_experiments.npy"), mmap_mode='r')
+
+	@property
+	def shape(self):
+		"""tuple: The (experiments, measures) shape of the cube."""
+		return self.values.shape
+
+	def column(self, measure_name):
+		"""A read-only, contiguous view of the values of one measure."""
+		return self.values[:, self._measure_index[measure_name]]
+
+	def select(self, measure_names):
+		"""
+		Values for a subset of measures.
+
+		Selecting a contiguous run of measures returns a view; any other
+		selection is gathered into a new array.
+		"""
+		j = [self._measure_index[name] for name in measure_names]
+		if j and j == list(range(j[0], j[0] + len(j))):
+			return self.values[:, j[0]:j[0] + len(j)]
+		return self.values[:, j]
+
+	def to_frame(self, measure_names=None):
+		"""Copy the cube (or some measures) into a DataFrame indexed by experiment."""
+		if measure_names is None:
+			measure_names = self.measure_names
+		return pd.DataFrame(
+			np.array(self.select(measure_names)),
+			index=pd.Index(np.array(self.experiment_ids), name='experiment'),
+			columns=list(measure_names),
+		)
@@ -0,0 +1,346 @@
+import io
+import time
+import json
+import numpy as np
+import pandas as pd
+import logging
+
+from emat_ve_metamodel import ScopeEncoder, metamodel_variables, experiment_set_hash, fit_metamodels
+
+_logger = logging.getLogger("EMAT.VEModel")
+
+
+def unit_features(encoder, U):
+	"""
+	Encode points of the unit hypercube over the encoded parameters.
+
+	Each parameter has one unit coordinate.  For real and integer
+	parameters it is the scaled value itself, boolean parameters are
+	True at or above 0.5, and categorical parameters take the value
+	whose equal-width slice of [0,1] holds the coordinate.
+
+	Args:
+		encoder (ScopeEncoder): The encoder of the scope.
+		U (numpy.ndarray): Unit coordinates, shape (n, n_parameters).
+
+	Returns:
+		numpy.ndarray: Features, shape (n, n_features).
+	"""
+	features = []
+	for j, (name, kind, info) in enumerate(encoder.columns):
+		u = U[:, j]
+		if kind == 'cat':
+			level = np.minimum((u * len(info)).astype(int), len(info) - 1)
+			features.extend((level == k).astype(np.float64) for k in range(len(info)))
+		elif kind == 'bool':
+			features.append((u >= 0.5).astype(np.float64))
+		else:
+			features.append(u)
+	return np.column_stack(features)
+
+
+def feature_scores(experiments, encoder, measure_names, bins=5):
+	"""
+	Score how much of each measure's variance each parameter explains.
+
+	Each parameter is binned (by quantiles, or by value for categorical
+	and boolean parameters), and the score is the share of a measure's
+	variance explained by the bin means, the correlation ratio.  All
+	measures are scored at once with a few matrix products, directly
+	from the experiments, with no model.  Scores are normalized to sum
+	to one over the parameters for each measure.
+
+	Args:
+		experiments (pandas.DataFrame): Experiment parameters and measures.
+		encoder (ScopeEncoder): The encoder of the scope.
+		measure_names (Collection[str]): The measures to score.
+		bins (int, default 5): Quantile bins for numeric parameters.
+
+	Returns:
+		pandas.DataFrame: Scores, with a row per parameter and a column
+		per measure.
+	"""
+	Y = experiments[list(measure_names)].to_numpy(dtype=np.float64)
+	Yc = Y - Y.mean(0)
+	total = (Yc**2).sum(0)
+	total[total == 0] = 1.0
+	scores = np.empty((len(encoder.columns), Y.shape[1]))
+	for j, (name, kind, info) in enumerate(encoder.columns):
+		x = experiments[name].to_numpy()
+		if kind == 'real':
+			edges = np.unique(np.quantile(x.astype(np.float64), np.linspace(0, 1, bins + 1)[1:-1]))
+			# Renumber the bins that are used, so none is empty.
+			_, codes = np.unique(np.searchsorted(edges, x, side='right'), return_inverse=True)
+		else:
+			_, codes = np.unique(x.astype(str), return_inverse=True)
+		B = np.zeros((len(x), codes.max() + 1))
+		B[np.arange(len(x)), codes] = 1.0
+		counts = B.sum(0)
+		sums = B.T @ Yc
+		scores[j] = (sums**2 / counts[:, None]).sum(0) / total
+	scores = scores / np.maximum(scores.sum(0), 1e-300)
+	return pd.DataFrame(scores, index=encoder.parameter_names, columns=list(measure_names))
+
+
+def morris_effects(engine, n_trajectories=100, levels=4, random_seed=0):
+	"""
+	Morris elementary effects of every parameter on every measure.
+
+	Trajectories are drawn on a `levels`-level grid of the unit
+	hypercube and evaluated with the metamodel, all in one prediction.
+	Effects are in measure units per full range of the parameter.
+
+	Args:
+		engine (MetamodelEngine): A fitted engine.
+		n_trajectories (int, default 100): The number of trajectories.
+		levels (int, default 4): The number of grid levels.
+		random_seed (int, default 0): Seed for the trajectories.
+
+	Returns:
+		(pandas.DataFrame, pandas.DataFrame):
+			The mean absolute effect (mu*) and the standard deviation
+			of the effects (sigma), with a row per parameter and a
+			column per measure.
+	"""
+	rng = np.random.default_rng(random_seed)
+	k = len(engine.encoder.columns)
+	r = n_trajectories
+	delta = levels / (2 * (levels - 1))
+
+	# Base points on the grid, low enough that a step up stays in range.
+	base = rng.integers(0, levels // 2, size=(r, k)) / (levels - 1)
+	signs = rng.choice([-1.0, 1.0], size=(r, k))
+	start = np.where(signs > 0, base, base + delta)
+	order = np.argsort(rng.random((r, k)), axis=1)
+
+	# Point i of a trajectory has the first i parameters of its order moved.
+	moved = np.zeros((r, k + 1, k), dtype=bool)
+	steps = np.arange(1, k + 1)
+	for i in steps:
+		moved[np.arange(r), i:, order[:, i - 1]] = True
+	U = start[:, None, :] + moved * (signs * delta)[:, None, :]
+
+	Y = engine.predict_array(unit_features(engine.encoder, U.reshape(-1, k)))
+	Y = Y.reshape(r, k + 1, -1)
+	effects = np.empty((r, k, Y.shape[2]))
+	effects[np.arange(r)[:, None], order] = np.diff(Y, axis=1) / (signs[np.arange(r)[:, None], order] * delta)[:, :, None]
+
+	index = engine.encoder.parameter_names
+	return (
+		pd.DataFrame(np.abs(effects).mean(0), index=index, columns=engine.measure_names),
+		pd.DataFrame(effects.std(0, ddof=1), index=index, columns=engine.measure_names),
+	)
+
+
+def sobol_indices(engine, n_samples=4096, random_seed=0):
+	"""
+	First order and total Sobol indices of every parameter on every measure.
+
+	Uses the Saltelli sampling scheme with the Saltelli (2010) first
+	order and Jansen total effect estimators, evaluated with the
+	metamodel for all measures in one prediction of
+	`n_samples * (n_parameters + 2)` points.
+
+	Args:
+		engine (MetamodelEngine): A fitted engine.
+		n_samples (int, default 4096): The base sample size.
+		random_seed (int, default 0): Seed for the samples.
+
+	Returns:
+		(pandas.DataFrame, pandas.DataFrame):
+			The first order (S1) and total (ST) indices, with a row per
+			parameter and a column per measure.
+	"""
+	rng = np.random.default_rng(random_seed)
+	k = len(engine.encoder.columns)
+	A = rng.random((n_samples, k))
+	B = rng.random((n_samples, k))
+	AB = np.repeat(A[None, :, :], k, axis=0)
+	AB[np.arange(k), :, np.arange(k)] = B.T
+
+	U = np.concatenate([A, B, AB.reshape(-1, k)])
+	Y = engine.predict_array(unit_features(engine.encoder, U))
+	fA = Y[:n_samples]
+	fB = Y[n_samples:2 * n_samples]
+	fAB = Y[2 * n_samples:].reshape(k, n_samples, -1)
+
+	variance = np.concatenate([fA, fB]).var(0)
+	variance[variance == 0] = 1.0
+	S1 = (fB[None] * (fAB - fA[None])).mean(1) / variance
+	ST = 0.5 * ((fA[None] - fAB)**2).mean(1) / variance
+
+	index = engine.encoder.parameter_names
+	return (
+		pd.DataFrame(S1, index=index, columns=engine.measure_names),
+		pd.DataFrame(ST, index=index, columns=engine.measure_names),
+	)
+
+
+_CREATE_SCREENING_CACHE = """
+CREATE TABLE IF NOT EXISTS ve_screening_cache (
+	scope_name TEXT NOT NULL,
+	experiment_set TEXT NOT NULL,
+	method TEXT NOT NULL,
+	created REAL,
+	result BLOB,
+	PRIMARY KEY (scope_name, experiment_set, method)
+)
+"""
+
+
+def _screening_to_bytes(result):
+	"""
+	Serialize screening results as an npz archive with a JSON header.
+
+	Like the metamodel cache, never a pickle, so reading results from a
+	shared database cannot execute code.
+	"""
+	header = {
+		name: {'index': [str(i) for i in df.index], 'columns': [str(c) for c in df.columns]}
+		for name, df in result.items()
+	}
+	arrays = {name: df.to_numpy(dtype=np.float64) for name, df in result.items()}
+	buffer = io.BytesIO()
+	np.savez_compressed(buffer, header=np.array(json.dumps(header)), **arrays)
+	return buffer.getvalue()
+
+
+def _screening_from_bytes(data):
+	with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+		header = json.loads(str(arrays['header']))
+		return {
+			name: pd.DataFrame(arrays[name], index=frame['index'], columns=frame['columns'])
+			for name, frame in header.items()
+		}
+
+
+def _read_screening(db, scope_name, experiment_set, method):
+	exists = db.conn.execute(
+		"SELECT name FROM sqlite_master WHERE type='table' AND name='ve_screening_cache'"
+	).fetchone()
+	if exists is None:
+		return None
+	row = db.conn.execute(
+		"SELECT result FROM ve_screening_cache WHERE scope_name=? AND experiment_set=? AND method=?",
+		(scope_name, experiment_set, method),
+	).fetchone()
+	if row is None:
+		return None
+	try:
+		return _screening_from_bytes(row[0])
+	except (ValueError, OSError, KeyError) as err:
+		# Rows pickled by earlier versions are never unpickled.
+		_logger.warning(f"SCREENING cached {method} for {scope_name} is unreadable, ignoring it: {err}")
+		return None
+
+
+def _store_screening(db, scope_name, experiment_set, method, result):
+	if db.readonly:
+		return
+	with db.conn:
+		db.conn.execute(_CREATE_SCREENING_CACHE)
+		db.conn.execute(
+			"INSERT OR REPLACE INTO ve_screening_cache VALUES (?,?,?,?,?)",
+			(scope_name, experiment_set, method, time.time(), _screening_to_bytes(result)),
+		)
+
+
+def screen_experiments(
+		db,
+		scope,
+		design_name=None,
+		measure_names=None,
+		methods=('feature_scoring', 'morris', 'sobol'),
+		n_trajectories=100,
+		n_samples=4096,
+		random_seed=0,
+):
+	"""
+	Screen the parameters for their effect on all measures at once.
+
+	Feature scoring works directly on the stored experiments; Morris
+	and Sobol analyses use the fitted metamodel (see `fit_metamodels`).
+	Results are cached in the database by scope, experiment set hash and
+	method, so screening again before new experiments land is a lookup.
+
+	Args:
+		db (emat.SQLiteDB): The database holding the experiments.
+		scope (emat.Scope): The scope.
+		design_name (str or Collection[str], optional): Limit the
+			experiments to these designs.
+		measure_names (Collection[str], optional): The measures to screen.
+			Defaults to the *metamodel_variables.csv* measures.
+		methods (Collection[str]): Any of 'feature_scoring', 'morris' and
+			'sobol'.
+		n_trajectories (int, default 100): Morris trajectories.
+		n_samples (int, default 4096): Sobol base sample size.
+		random_seed (int, default 0): Seed for the Morris and Sobol samples.
+
+	Returns:
+		dict: DataFrames of results, with a row per parameter and a column
+		per measure, under the keys 'feature_scoring', 'morris_mu_star',
+		'morris_sigma', 'sobol_S1' and 'sobol_ST' for the methods run.
+	"""
+	unknown = set(methods) - {'feature_scoring', 'morris', 'sobol'}
+	if unknown:
+		raise ValueError(f"unknown screening methods: {', '.join(sorted(unknown))}")
+	if measure_names is None:
+		measure_names = metamodel_variables(scope)
+	measure_names = list(measure_names)
+	experiments = db.read_experiment_all(scope.name, design_name, only_with_measures=True)
+	experiments = experiments.loc[experiments[measure_names].notnull().all(axis=1)]
+	experiment_set = experiment_set_hash(experiments.index.get_level_values(0), measure_names, experiments[measure_names])
+
+	results = {}
+	for method in methods:
+		if method == 'morris':
+			key = f"morris/{n_trajectories}/{random_seed}"
+		elif method == 'sobol':
+			key = f"sobol/{n_samples}/{random_seed}"
+		else:
+			key = method
+		cached = _read_screening(db, scope.name, experiment_set, key)
+		if cached is None:
+			start = time.time()
+			if method == 'feature_scoring':
+				cached = {'feature_scoring': feature_scores(experiments, ScopeEncoder(scope), measure_names)}
+			else:
+				engine = fit_metamodels(db, scope, design_name, measure_names)
+				if method == 'morris':
+					mu_star, sigma = morris_effects(engine, n_trajectories, random_seed=random_seed)
+					cached = {'morris_mu_star': mu_star, 'morris_sigma': sigma}
+				else:
+					S1, ST = sobol_indices(engine, n_samples, random_seed=random_seed)
+					cached = {'sobol_S1': S1, 'sobol_ST': ST}
+			_store_screening(db, scope.name, experiment_set, key, cached)
+			_logger.info(
+				f"SCREENING {method} of {scope.name} [{experiment_set}] for "
+				f"{len(measure_names)} measures in {time.time() - start:.1f}s"
+			)
+		else:
+			_logger.info(f"SCREENING {method} cache hit for {scope.name} [{experiment_set}]")
+		results.update(cached)
+	return results
+
+
+def influential_parameters(results, threshold=0.05, key=None):
+	"""
+	The parameters that matter for at least one measure.
+
+	Args:
+		results (dict): Results from `screen_experiments`.
+		threshold (float, default 0.05): The score a parameter must reach
+			for some measure.  For Morris mu*, which is in measure units,
+			the score is mu* relative to the largest mu* for the measure.
+		key (str, optional): The result to use.  Defaults to 'sobol_ST',
+			'morris_mu_star' or 'feature_scoring', the first available.
+
+	Returns:
+		list of str
+	"""
+	if key is None:
+		key = next(k for k in ('sobol_ST', 'morris_mu_star', 'feature_scoring') if k in results)
+	scores = results[key]
+	if key == 'morris_mu_star':
+		scores = scores / scores.max(0).replace(0, 1)
+	return list(scores.index[(scores >= threshold).any(axis=1)])
@@ -6,16 +6,37 @@ import logging
 import tempfile
 import re
 import shutil
+import stat
 import platform
 import subprocess
 import json
+import time
+import fnmatch
+import hashlib
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from distutils.dir_util import copy_tree
-from distutils.file_util import copy_file
 
 from emat import Scope, SQLiteDB
+from emat.exceptions import MissingArchivePathError
 from emat.model.core_files import FilesCoreModel
 from emat.model.core_files.parsers import TableParser, MappingParser, loc, key, iloc
 
+from emat_ve_metamodel import ScopeEncoder, GaussianProcessMetamodel, MetamodelService, metamodel_variables, fit_metamodels
+from emat_ve_results import export_experiments
+from emat_ve_screening import screen_experiments
+from emat_ve_explorer import ScenarioExplorer, ExplorerService
+from emat_ve_optimization import RobustOptimizer
+from emat_ve_database import MeasureWriter, QueuedWriteDB
+from emat_ve_blend import BlendBasis, piecewise_weights
+from emat_ve_bundle import build_bundle, find_bundle, unpack_bundle, worker_bundle_path
+from emat_ve_failures import (
+	failure_record, error_message, write_ve_failure, read_failures,
+	failures_by_signature, failure_regions, in_failure_regions,
+)
+
 _logger = logging.getLogger("EMAT.VEModel")
 
 # The demo model code is located in the same
@@ -36,6 +57,259 @@ def r_join_norm(*args):
 	"""Normalize joined paths."""
 	return os.path.normpath(os.path.join(*args)).replace('\\','/')
 
+def read_csv_index_character(filename, index_colname, **kwargs,):
+	"""Read a csv file, indexed by a column converted to strings."""
+	df = pd.read_csv(filename, **kwargs)
+	df = df.set_index(index_colname)
+	df.index = df.index.map(str)
+	return df
+
+
+# Resolved R environments, one per (r_executable, r_runtime_path,
+# r_library_path), so each process resolves and probes R only once.
+_r_environments = {}
+_r_environments_lock = threading.Lock()
+
+REnvironment = namedtuple('REnvironment', ['rscript', 'env', 'version'])
+
+
+def r_environment(r_executable, r_runtime_path, r_library_path=None):
+	"""
+	The Rscript command and subprocess environment for running VE.
+
+	The environment is resolved once per process and cached.  It is a
+	copy of this process's environment with the R binary directory put
+	first on PATH, `r_library_path` put first on R_LIBS, and
+	R_PROFILE_USER set to a profile that loads the VisionEval runtime,
+	so no `.Rprofile` is needed in any working directory.  The first
+	resolution runs a quick R probe in that environment, profile and
+	all, to check that Rscript starts, loads the VisionEval runtime and
+	finds the visioneval package.
+
+	Args:
+		r_executable (str): The R binary directory, or the Rscript file.
+		r_runtime_path (str): The VisionEval runtime directory.
+		r_library_path (str, optional): The VisionEval package library.
+
+	Returns:
+		REnvironment: The `rscript` path, the read-only `env` mapping
+		(pass `dict(env)` to subprocess), and the R `version` string.
+
+	Raises:
+		FileNotFoundError: If Rscript cannot be found.
+		RuntimeError: If the R probe fails.
+	"""
+	env_key = (r_executable, r_runtime_path, r_library_path)
+	with _r_environments_lock:
+		if env_key in _r_environments:
+			return _r_environments[env_key]
+
+		r_executable = join_norm(r_executable)
+		if os.path.isfile(r_executable):
+			rscript, r_bin = r_executable, os.path.dirname(r_executable)
+		else:
+			rscript, r_bin = shutil.which('Rscript', path=r_executable), r_executable
+		if rscript is None:
+			rscript = shutil.which('Rscript')
+		if rscript is None:
+			raise FileNotFoundError(f"Rscript not found in {r_executable} or on PATH")
+
+		env = dict(os.environ)
+		path_key = next((k for k in env if k.upper() == 'PATH'), 'PATH')
+		env[path_key] = os.pathsep.join(p for p in (r_bin, env.get(path_key)) if p)
+		if r_library_path:
+			env['R_LIBS'] = os.pathsep.join(p for p in (r_join_norm(r_library_path), env.get('R_LIBS')) if p)
+
+		profile = join_norm(
+			tempfile.gettempdir(),
+			f"emat_ve_{hashlib.sha1(r_join_norm(r_runtime_path).encode()).hexdigest()[:12]}.Rprofile",
+		)
+		content = f'source(file.path("{r_join_norm(r_runtime_path)}", "VisionEval.R"), chdir=TRUE)\n'
+		if not os.path.exists(profile) or open(profile, 'rt').read() != content:
+			with open(profile, 'wt') as rprof:
+				rprof.write(content)
+		env['R_PROFILE_USER'] = profile
+
+		# Not --vanilla, which would skip R_PROFILE_USER; the runtime
+		# profile may print, so the version is marked.
+		probe = subprocess.run(
+			[
+				rscript, '-e',
+				'if (!nzchar(system.file(package="visioneval"))) quit(status=3); '
+				'if (!exists("openModel")) quit(status=4); '
+				'cat("\\nR_VERSION:", R.version.string, "\\n")',
+			],
+			env=env,
+			capture_output=True,
+		)
+		if probe.returncode:
+			raise RuntimeError(
+				f"R probe failed with {rscript} (return code {probe.returncode}), "
+				f"check r_executable, r_runtime_path and r_library_path: {probe.stderr.decode(errors='replace').strip()}"
+			)
+		version = probe.stdout.decode(errors='replace').rpartition('R_VERSION:')[2].strip()
+		_logger.info(f"R ENVIRONMENT {version} at {rscript}")
+
+		environment = REnvironment(rscript, MappingProxyType(env), version)
+		_r_environments[env_key] = environment
+		return environment
+
+
+def drop_in_file(src, dst, mode='copy'):
+	"""
+	Put a drop-in file in place, as a copy or a link to the original.
+
+	Links are made by replacing `dst`, never by writing through it, so
+	the original is not changed, and the original is made read-only
+	first, so a model that opens the link for writing fails rather
+	than changing it.  If a link cannot be made (e.g. across file
+	systems, or symlinks without privileges on Windows), the file is
+	copied instead.
+
+	Args:
+		src (str): The drop-in file.
+		dst (str): The path to put it at.
+		mode (str, default 'copy'): One of 'copy', 'hardlink' or 'symlink'.
+
+	Returns:
+		str: The mode actually used.
+	"""
+	if mode in ('hardlink', 'symlink'):
+		protect_drop_in(src)
+		if os.path.lexists(dst):
+			if os.path.exists(dst) and os.path.samefile(src, dst):
+				return mode
+			_remove_link(dst)
+		try:
+			if mode == 'hardlink':
+				os.link(src, dst)
+			else:
+				os.symlink(os.path.abspath(src), dst)
+			return mode
+		except OSError as err:
+			_logger.debug(f"DROP-IN {mode} failed, copying {src}: {err}")
+	elif os.path.islink(dst) or (os.path.exists(dst) and os.stat(dst).st_nlink > 1):
+		# Copying onto a link left by an earlier run would write through it.
+		_remove_link(dst)
+	shutil.copyfile(src, dst)
+	return 'copy'
+
+
+def drop_in_changed_message(changed):
+	"""
+	The error for linked drop-in files changed by a model run.
+
+	Args:
+		changed (Mapping[str, str]): The changed original for each linked path.
+
+	Returns:
+		str
+	"""
+	sources = sorted(set(changed.values()))
+	return (
+		f"the model run changed {len(sources)} linked drop-in input files, "
+		f"set drop_in_links to 'copy' and restore these from source control: {sources}"
+	)
+
+
+def protect_drop_in(path):
+	"""
+	Make a drop-in file read-only, so links to it cannot be written through.
+
+	Args:
+		path (str): The drop-in file.
+	"""
+	mode = stat.S_IMODE(os.stat(path).st_mode)
+	readonly = mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+	if readonly != mode:
+		os.chmod(path, readonly)
+
+
+def _remove_link(path):
+	"""
+	Remove a linked drop-in, which Windows refuses while it is read-only.
+
+	Making a hard link writable also makes the original writable, so
+	callers protect the original again after removing its link.
+	"""
+	try:
+		os.remove(path)
+	except PermissionError:
+		os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IWUSR)
+		os.remove(path)
+
+
+def extraction_tables(script_path):
+	"""
+	The Datastore tables read by an extraction script.
+
+	Tables are found from the `Table = "Name"` and `Table = list(Name = ...)`
+	arguments of the script's datastore queries.
+
+	Args:
+		script_path (str): The path to the extraction R script.
+
+	Returns:
+		set: The table names.
+	"""
+	with open(script_path, 'rt') as f:
+		script = f.read()
+	tables = set(re.findall(r'\bTable\s*=\s*"(\w+)"', script))
+	for block in re.findall(r'\bTable\s*=\s*list\((.*?)\n\s*\)', script, flags=re.DOTALL):
+		tables.update(re.findall(r'(\w+)\s*=\s*c\(', block))
+	return tables
+
+
+# Year-indexed transforms of template input files, keyed by the scope
+# parameter that drives them.  The `year_transforms` section of the model
+# config can add to or override these.  Each entry gives:
+#   file: the template file in the parameter's scenario input directory
+#   method: 'growth' compounds the parameter value from the base year,
+#           'insert' sets the value in the future year, and
+#           'scale' multiplies by the parameter value
+#   columns: the columns to transform, as a list (using the value of the
+#           entry's parameter) or as a mapping of column to parameter name
+#   years (optional): the years to transform; 'insert' defaults to the
+#           model year, the others to all years in the file
+DEFAULT_YEAR_TRANSFORMS = {
+	'INCOMEGROWTHRATE': {
+		'file': 'azone_per_cap_inc.csv',
+		'method': 'growth',
+		'columns': ['HHIncomePC.2005', 'GQIncomePC.2005'],
+	},
+	'SHDCARSVCOCCUPRATE': {
+		'file': 'region_carsvc_shd_occup.csv',
+		'method': 'insert',
+		'columns': ['ShdCarSvcAveOccup'],
+	},
+	'DRVLESSPROPREMOTEACC': {
+		'file': 'region_driverless_vehicle_parameter.csv',
+		'method': 'insert',
+		'columns': {
+			'PropRemoteAccess': 'DRVLESSPROPREMOTEACC',
+			'PropParkingFeeAvoid': 'PROPPARKINGFEEAVOID',
+		},
+	},
+}
+
+# How each scope parameter manipulates the model inputs, where this differs
+# from the default inferred from the scope (categorical parameters drop in
+# files, parameters with a year transform use it, and all others mix the
+# files in the "1" and "2" scenario folders).  The `manipulations` section
+# of the model config can add to or override these.  Each entry gives a
+# `strategy`, one of mixture, blend, delta, scale, drop-in, script-swap,
+# year-transform or none, plus options for that strategy: `no_mix_cols`
+# and `float_dtypes` (mixture, blend, delta), `columns` (scale),
+# `anchors` with either `knots` or `weights` (blend, see
+# `_manipulate_by_blend`) and `scenario_dir` (to use a folder other than
+# the parameter's address).
+DEFAULT_MANIPULATIONS = {
+	'LANEMILESCEN': {'strategy': 'delta'},
+	'TAXSCEN': {'strategy': 'mixture', 'no_mix_cols': ('Year', 'Geo', 'FuelTax.2005')},
+	'TRANSITSCEN': {'strategy': 'mixture', 'float_dtypes': True},
+	'POWERTRAINSCEN': {'strategy': 'script-swap'},
+}
+
 
 class VEModel(FilesCoreModel):
 	"""
@@ -56,9 +330,14 @@ class VEModel(FilesCoreModel):
 			A YAML file that defines the scope for these model
 			runs. If not given, the default scope stored in this
 			package directly is used.
+		lazy (bool, default False):
+			Defer installing the VE model until it is first needed
+			by `setup`, `run` or `post_process`.  Use this to open
+			a database or post-process archived results without
+			waiting for the model installation.
 	"""
 
-	def __init__(self, db=None, db_filename="verspm.db", scope=None):
+	def __init__(self, db=None, db_filename="verspm.db", scope=None, lazy=False):
 
 		# Make a temporary directory for this instance.
 		self.master_directory = tempfile.TemporaryDirectory(dir=join_norm(this_directory,'Temporary'))
@@ -117,25 +396,183 @@ class VEModel(FilesCoreModel):
 		# Create a scenario input directory dictionary
 		self.scenario_input_dirs = {parameter.name:parameter.address for parameter in self.scope.get_parameters()} 
 
-		# Ensuring R Exe path is in env.
-		os.environ['path'] = join_norm(self.config['r_executable'])+';'+os.environ['path']
+		self.modelname = self.config['model_type'] + '-' + self.config['model_variant']
+		self.model_path = r_join_norm(self.local_directory, self.modelname)
 
-		# Ensure that R paths are set correctly.
-		r_lib = self.config['r_library_path']
-		r_runtime_path = self.config['r_runtime_path']
+		# Add the model year and base year
+		self.model_base_year = int(self.config['base_year'])
+		self.model_future_year = int(self.config['model_year'])
 
-		with open(join_norm(self.local_directory, '.Rprofile'), 'wt') as rprof:
-			rprof.write(f'source(file.path("{r_runtime_path}", "VisionEval.R"), chdir=TRUE)')
+		# Year-indexed transforms, and a cache of their parsed templates.
+		self.year_transforms = dict(DEFAULT_YEAR_TRANSFORMS)
+		self.year_transforms.update(self.config.get('year_transforms', None) or {})
+		self._year_transform_templates = {}
+
+		# Categorical drop-ins are copied, or linked if `drop_in_links` is
+		# 'hardlink' or 'symlink'.  Linked originals are made read-only,
+		# folder listings are cached per level, and linked files are
+		# checked after each run, see `_check_drop_in_links`.
+		self.drop_in_links = self.config.get('drop_in_links', 'copy')
+		if self.drop_in_links not in ('copy', 'hardlink', 'symlink'):
+			raise ValueError(f"drop_in_links must be copy, hardlink or symlink, not {self.drop_in_links}")
+		self._drop_in_scans = {}
+		self._drop_in_linked = {}
+		self._drop_in_lock = threading.Lock()
+
+		# Anchor files of blended parameters, read once, see `_manipulate_by_blend`.
+		self._blend_bases = {}
+
+		# What to keep of each run's Datastore after extraction: 'all',
+		# 'extraction' (the groups and tables the extract script reads,
+		# plus `datastore_keep`), or 'none'.  See `_prune_datastore`.
+		self.datastore_retention = self.config.get('datastore_retention', 'all')
+		if self.datastore_retention not in ('all', 'extraction', 'none'):
+			raise ValueError(f"datastore_retention must be all, extraction or none, not {self.datastore_retention}")
+		self.datastore_keep = list(self.config.get('datastore_keep', None) or ['Global'])
+
+		# The model bundle for dask workers, see `distribute_model`.  Copies
+		# of the model carry only its name and digest; workers look for it
+		# in their local directory, then `bundle_cache`.
+		self.bundle_cache = self.config.get('bundle_cache', None)
+		self._model_bundle = None
+
+		# The experiment being run, its parameters, start time and stage,
+		# for recording failures, see `_record_failure`.
+		self._failure_context = None
+
+		# The manipulation plan, compiled once from the scope and config.
+		self.manipulations = self._compile_manipulations()
+
+		# Measure parsers are built on first use, see `_build_parsers`.
+		self._parsers_built = False
+
+		self._installed = False
+		if not lazy:
+			self._install_model()
+
+
+	def __getstate__(self):
+		state = super().__getstate__()
+		# The writer's sockets and threads stay in this process; workers
+		# get its address and open a QueuedWriteDB instead of a SQLiteDB.
+		# Blend bases are rebuilt on first use rather than shipped.
+		state['_blend_bases'] = {}
+		state.pop('_drop_in_lock', None)
+		writer = state.pop('_measure_writer', None)
+		if writer is not None:
+			database_path = state.pop('_sqlitedb_path_', None) or state.get('_sqlitedb_path')
+			state.pop('_sqlitedb_readonly_', None)
+			state['_queued_write_db_'] = (database_path, writer.address, writer.authkey)
+		return state
+
+	def __setstate__(self, state):
+		queued_write_db = state.pop('_queued_write_db_', None)
+		super().__setstate__(state)
+		self._drop_in_lock = threading.Lock()
+		if queued_write_db is not None:
+			self.db = QueuedWriteDB(*queued_write_db)
+
+	def start_measure_writer(self, host='localhost', **kwargs):
+		"""
+		Route all workers' database writes through a single writer.
+
+		With many workers each writing results through its own SQLite
+		connection, writes contend for the database file lock and can
+		fail with "database is locked".  After this is called, copies
+		of this model sent to workers write through a `MeasureWriter`
+		running in this process, which commits them in batches, while
+		their reads use WAL snapshots.
+
+		Args:
+			host (str, default 'localhost'):
+				The interface for the writer to listen on.  Use a host
+				name reachable from the workers if they run on other
+				machines that share the database file.
+			**kwargs:
+				Other arguments passed to `MeasureWriter`.
+
+		Returns:
+			MeasureWriter
+		"""
+		database_path = getattr(self, '_sqlitedb_path', None)
+		if database_path is None:
+			raise ValueError("the measure writer requires a SQLite database file")
+		if getattr(self, '_measure_writer', None) is None:
+			self._measure_writer = MeasureWriter(database_path, host=host, **kwargs).start()
+		return self._measure_writer
+
+	def stop_measure_writer(self):
+		"""
+		Commit any pending writes and stop the measure writer.
+
+		Raises:
+			RuntimeError: If any writes failed to commit since the
+				writer was last flushed.
+		"""
+		writer = getattr(self, '_measure_writer', None)
+		if writer is not None:
+			self._measure_writer = None
+			writer.stop()
+
+	def distribute_model(self, client=None):
+		"""
+		Ship the installed model to dask workers as a bundle.
+
+		Without this, each worker copies the model tree from this
+		model's local directory for every experiment, which only works
+		if that directory is visible on the worker's machine.  This packs
+		the model once into a compressed bundle named for its content
+		hash, kept in `bundle_cache` (or `bundles/` in the local
+		directory).  Copies of this model sent to the workers carry only
+		the bundle's name and digest; each worker finds the bundle in its
+		local directory or `bundle_cache`, unpacks it once and reuses it
+		for every experiment.
+
+		With `client`, each worker is asked whether it can find the
+		bundle, and if any cannot, the bundle is uploaded into the local
+		directory of every worker (and of workers that join later), so
+		no shared file system is needed.  A bundle already in the cache
+		for the same model is reused.
+
+		Args:
+			client (dask.distributed.Client, optional):
+				The client of the workers to ship the bundle to.
+
+		Returns:
+			ModelBundle
+
+		Raises:
+			FileNotFoundError: If some workers still cannot find the
+				bundle after it is uploaded.
+		"""
+		self._ensure_installed()
+		cache_dir = self.bundle_cache or join_norm(self.local_directory, 'bundles')
+		self._model_bundle = build_bundle(join_norm(self.local_directory, self.modelname), cache_dir)
+		if client is not None:
+			bundle = self._model_bundle
+			found = client.run(worker_bundle_path, bundle, self.bundle_cache)
+			missing = [address for address, path in found.items() if path is None]
+			if missing:
+				client.upload_file(bundle.path)
+				_logger.info(f"BUNDLE {bundle.name} pushed to workers, {len(missing)} did not have it")
+				found = client.run(worker_bundle_path, bundle, self.bundle_cache)
+				missing = [address for address, path in found.items() if path is None]
+			if missing:
+				raise FileNotFoundError(f"model bundle {bundle.name} is not on workers {missing} after upload")
+			_logger.info(f"BUNDLE {bundle.name} on {len(found)} workers")
+		return self._model_bundle
+
+	def _install_model(self):
+		"""
+		Install the VE model into the local directory.
+
+		This runs VisionEval's `installModel` through Rscript, configured
+		to load the base year model.
+		"""
+		r_env = self.r_environment()
 
-		cmd = 'Rscript'
-		
-		self.modelname = self.config['model_type'] + '-' + self.config['model_variant']
 		modelpath = r_join_norm(self.local_directory, self.modelname)
 		self.model_path = modelpath
-		
-		# Add the model year and base year
-		self.model_base_year = int(self.config['base_year'])
-		self.model_future_year = int(self.config['model_year'])
 
 		with open(join_norm(self.local_directory, 'veinstaller.R'), 'wt') as veinstaller:
 			veinstaller.write(f"""
@@ -165,25 +602,43 @@ class VEModel(FilesCoreModel):
 			ematmodel$configure()
 			""")
 
-		# print(arg)
-		# print([cmd, '-e', arg])
-		
-
+		_logger.info(f"{self.config['model_type']} INSTALL to {modelpath}")
 		results = subprocess.run(
-			 [cmd, 'veinstaller.R'],
+			 [r_env.rscript, 'veinstaller.R'],
 		 	cwd=self.local_directory,
+		 	env=dict(r_env.env),
 		 	capture_output=False)
-		
-		print(results)
 
-		def read_csv_index_character(filename, index_colname, **kwargs,):
-			df = pd.read_csv(filename, **kwargs)
-			df = df.set_index(index_colname)
-			df.index = df.index.map(str)
-			return df
+		_logger.debug(f"{self.config['model_type']} INSTALL {results}")
+		self._installed = True
+
+	def r_environment(self):
+		"""
+		The Rscript command and subprocess environment for this model.
+
+		See `r_environment` (the module function), which resolves and
+		probes R once per process for the configured R paths.
+
+		Returns:
+			REnvironment
+		"""
+		return r_environment(
+			self.config['r_executable'],
+			self.config['r_runtime_path'],
+			self.config.get('r_library_path', None),
+		)
 
-		for measure in scope.get_measures():
-			instructions = {}			
+	def _ensure_installed(self):
+		"""Install the VE model if that has been deferred."""
+		if not getattr(self, '_installed', True):
+			self._install_model()
+
+	def _build_parsers(self):
+		"""Create the measure parsers from the scope, if not already done."""
+		if getattr(self, '_parsers_built', True):
+			return
+		for measure in self.scope.get_measures():
+			instructions = {}
 			if measure.parser:
 				if measure.parser.get('loc'):
 					instructions[measure.name] = loc[(str(j) for j in measure.parser.get('loc'))]
@@ -195,7 +650,123 @@ class VEModel(FilesCoreModel):
 					index_colname='Measure',
 				)
 			)
-		
+		self._parsers_built = True
+
+	def get_parser(self, idx):
+		self._build_parsers()
+		return super().get_parser(idx)
+
+	def load_measures(self, measure_names=None, *, rel_output_path=None, abs_output_path=None):
+		self._build_parsers()
+		self._failure_stage('load_measures')
+		try:
+			return super().load_measures(
+				measure_names,
+				rel_output_path=rel_output_path,
+				abs_output_path=abs_output_path,
+			)
+		except Exception as err:
+			self._record_failure(repr(err))
+			raise
+
+
+	def run_model(self, scenario, policy):
+		"""
+		Run one experiment, recording any failure in the `ve_failures` table.
+
+		This extends `AbstractCoreModel.run_model`.  Failures in `setup`,
+		`run`, `post_process` or `load_measures` are recorded with the
+		experiment id and parameters, the stage, the failing VE module
+		found in the logs, an error signature and the time from the start
+		of the experiment, see `failures`.
+		"""
+		experiment_id = policy.get('_experiment_id_', None)
+		if experiment_id is None:
+			experiment_id = scenario.get('_experiment_id_', None)
+		params = dict(scenario)
+		params.update(policy)
+		self._failure_context = {
+			'experiment_id': experiment_id,
+			'params': params,
+			'started': time.time(),
+			'stage': 'setup',
+		}
+		try:
+			return super().run_model(scenario, policy)
+		except Exception as err:
+			# Errors in run, post_process and load_measures are caught by
+			# run_model; those that escape it are from setup or archive.
+			self._record_failure(repr(err))
+			raise
+		finally:
+			self._failure_context = None
+
+	def _failure_stage(self, stage):
+		"""Note the stage of the experiment being run, if any."""
+		if getattr(self, '_failure_context', None) is not None:
+			self._failure_context['stage'] = stage
+
+	def _record_failure(self, message, log_text=''):
+		"""
+		Record a failure of the experiment being run by `run_model`.
+
+		The record is written to the `ve_failures` table of the database,
+		and to *failure.json* in the experiment's archive.  Nothing is
+		recorded outside `run_model`.
+
+		Args:
+			message (str): The error message.
+			log_text (str, optional): Model output to find the failing
+				VE module in, in addition to the VE log file.
+		"""
+		context = getattr(self, '_failure_context', None)
+		if context is None or context.get('recorded'):
+			return
+		context['recorded'] = True
+		record = failure_record(
+			self.scope.name,
+			context['experiment_id'],
+			context['params'],
+			context['stage'],
+			message,
+			log_text=self._ve_log_text() + log_text,
+			duration=time.time() - context['started'],
+			run_id=getattr(self, 'run_id', None),
+		)
+		self._store_failure(record)
+
+	def _store_failure(self, record):
+		"""Write a failure record to the database and the experiment archive."""
+		_logger.error(
+			f"FAILURE {record['signature']} experiment {record['experiment_id']} "
+			f"in {record['stage']} ({record['module'] or 'no module'}): {record['message']}"
+		)
+		db = getattr(self, 'db', None)
+		if db is not None and not db.readonly:
+			try:
+				write_ve_failure(db, record)
+			except Exception:
+				_logger.exception("error writing failure record")
+		if record['experiment_id'] is not None:
+			try:
+				ex_archive_path = self.get_experiment_archive_path(record['experiment_id'], makedirs=True)
+			except MissingArchivePathError:
+				pass
+			else:
+				with open(os.path.join(ex_archive_path, 'failure.json'), 'wt') as f:
+					json.dump(record, f, indent=2)
+
+	def _ve_log_text(self, model_dir=None):
+		"""The text of the newest VE log file in a model's results, or ''."""
+		results = join_norm(model_dir or self.resolved_model_path, 'results')
+		if not os.path.isdir(results):
+			return ''
+		logs = [i for i in os.scandir(results) if i.is_file() and fnmatch.fnmatch(i.name, 'Log*.txt')]
+		if not logs:
+			return ''
+		newest = max(logs, key=lambda i: i.stat().st_mtime)
+		with open(newest.path, 'rt', errors='replace') as f:
+			return f.read()
 
 
 	def setup(self, params: dict):
@@ -236,9 +807,6 @@ class VEModel(FilesCoreModel):
 
 		super().setup(params)
 
-		# Set R environment path to run R and use visioneval to install model
-		os.environ['path'] = join_norm(self.config['r_executable'])+';'+os.environ['path']
-
 		# Check if we are using distributed multi-processing. If so,
 		# we'll need to copy some files into a local working directory,
 		# as otherwise changes in the files will over-write each other
@@ -255,7 +823,7 @@ class VEModel(FilesCoreModel):
 			# in multi-processing mode, and we can just use
 			# the main cwd as the working directory without
 			# copying anything.
-			pass
+			self._ensure_installed()
 		else:
 			# If we do find we are running this setup on a
 			# worker, then we want to set the local directory
@@ -272,70 +840,140 @@ class VEModel(FilesCoreModel):
 				# it should install model once again in the worker's local directory
 				self.archive_path = os.path.abspath(self.resolved_archive_path)
 
-				_logger.debug(f"DISTRIBUTED.COPY FROM {self.local_directory}")
-				_logger.debug(f"                   TO {worker.local_directory}")
-				copy_tree(
-					join_norm(self.local_directory, self.modelname),
-					join_norm(worker.local_directory, self.modelname),
-				)
-				copy_file(
-					join_norm(self.local_directory, '.Rprofile'),
-					join_norm(worker.local_directory, '.Rprofile'),
-				)
-				self.local_directory = worker.local_directory
-				self.model_path = join_norm(worker.local_directory, self.modelname)
+				if self._installed and self._model_bundle is not None:
+					# Unpack the distributed bundle, once per worker.
+					bundle = self._model_bundle
+					bundle_path = find_bundle(bundle, [worker.local_directory, self.bundle_cache])
+					if bundle_path is None:
+						raise FileNotFoundError(
+							f"model bundle {bundle.name} is not on worker {worker.address}, "
+							f"call distribute_model with the client or set bundle_cache"
+						)
+					self.local_directory = worker.local_directory
+					self.model_path = join_norm(worker.local_directory, self.modelname)
+					unpack_bundle(bundle, bundle_path, self.model_path)
+				elif self._installed:
+					_logger.debug(f"DISTRIBUTED.COPY FROM {self.local_directory}")
+					_logger.debug(f"                   TO {worker.local_directory}")
+					copy_tree(
+						join_norm(self.local_directory, self.modelname),
+						join_norm(worker.local_directory, self.modelname),
+					)
+					self.local_directory = worker.local_directory
+					self.model_path = join_norm(worker.local_directory, self.modelname)
+				else:
+					# Installation was deferred, so install directly into
+					# the worker's directory, unless an earlier experiment
+					# on this worker already did.
+					self.local_directory = worker.local_directory
+					self.model_path = join_norm(worker.local_directory, self.modelname)
+					if os.path.isdir(self.model_path):
+						self._installed = True
+					else:
+						self._install_model()
+			else:
+				self._ensure_installed()
 
 		# The process of manipulating each input file is broken out
 		# into discrete sub-methods, as each step is loosely independent
-		# and having separate methods makes this clearer.
-		tmip_vars = [var_name.upper() for var_name in params.keys()]
-		if 'LUDENSITYMIX' in tmip_vars:
-			self._manipulate_ludensity(params)
-		if 'INTDENSITYSCEN' in tmip_vars:
-			self._manipulate_intdensity(params)
-		if 'HHPOPGROWTHRATE' in tmip_vars:
-			self._manipulate_population(params)
-		if 'INCOMEGROWTH' in tmip_vars:
-			self._manipulate_income(params)
-		if 'LDVECODRVSCEN' in tmip_vars:
-			self._manipulate_ldvecodrv(params)
-		if 'CARSVCAVAILSCEN' in tmip_vars:
-			self._manipulate_carsvcavail(params)
-		if 'SHDCARSVCOCCUPRATE' in tmip_vars:
-			self._manipulate_shdcarsvc(params)
-		if 'DRVLESSADJSCEN' in tmip_vars:
-			self._manipulate_drvlessadj(params)
-		if 'DRVLESSPROPREMOTEACC' in tmip_vars and 'PROPPARKINGFEEAVOID' in tmip_vars:
-			self._manipulate_drvless_param(params)
-		if 'AVVEHSALESGROWTHSCEN' in tmip_vars:
-			self._manipulate_drvlessvehsales(params)
-		if 'CARCHARGEAVAILSCEN' in tmip_vars:
-			self._manipulate_carchargeavailscen(params)
-		if 'CICHANGERATESCEN' in tmip_vars:
-			self._manipulate_cichange(params)
-		if 'INVESTMENTSCEN' in tmip_vars:
-			self._manipulate_inv(params)
-		if 'SOVDIVIVERTSCEN' in tmip_vars:
-			self._manipulate_sovdivert(params)
-		if 'TAXSCEN' in tmip_vars:
-			self._manipulate_taxes(params)
-		if 'LANEMILESCEN' in tmip_vars:
-			self._manipulate_mlanemiles(params)
-		if 'OPSDEPLOYSCEN' in tmip_vars:
-			self._manipulate_opsdeployment(params)
-		if 'TRANSITSERVICESCEN' in tmip_vars:
-			self._manipulate_transitservice(params)
-		if 'TDMINVESTMENTSCEN' in tmip_vars:
-			self._manipulate_tdmareatype(params)
-		if 'TRANSITSCEN' in tmip_vars:
-			self._manipulate_transitscen(params)
-		if 'POWERTRAINSCEN' in tmip_vars:
-			self._manipulate_powertrainscen(params)
+		# and having separate methods makes this clearer.  Which method
+		# applies to each parameter is set by the compiled manipulation
+		# plan, and as each writes different files they can run in parallel.
+		plan = [(name, entry) for name, entry in self.manipulations.items() if name in params]
+		setup_threads = int(self.config.get('setup_threads', 4))
+		if setup_threads > 1 and len(plan) > 1:
+			with ThreadPoolExecutor(max_workers=setup_threads) as pool:
+				futures = [pool.submit(self._apply_manipulation, params, name, entry) for name, entry in plan]
+				for future in futures:
+					future.result()
+		else:
+			for name, entry in plan:
+				self._apply_manipulation(params, name, entry)
 
 		_logger.info(f"{self.config['model_type']} SETUP complete")
 
 
-	def _manipulate_by_categorical_drop_in(self, params, cat_param, ve_scenario_dir):
+	def _compile_manipulations(self):
+		"""
+		Compile the manipulation plan for the scope parameters.
+
+		Returns:
+			dict: For each parameter that manipulates the model inputs,
+			the strategy and options to apply.
+		"""
+		overrides = dict(DEFAULT_MANIPULATIONS)
+		overrides.update(self.config.get('manipulations', None) or {})
+
+		# Parameters that feed another parameter's year transform or
+		# blend are applied there, and need no manipulation of their own.
+		consumed = set()
+		for param_name, spec in self.year_transforms.items():
+			if isinstance(spec['columns'], dict):
+				consumed.update(p for p in spec['columns'].values() if p != param_name)
+		for param_name, entry in overrides.items():
+			if entry.get('strategy') == 'blend':
+				consumed.update(p for p in entry.get('weights', ()) if p != param_name)
+
+		manipulations = {}
+		for p in self.scope.get_parameters():
+			if p.name in overrides and p.name not in consumed:
+				entry = dict(overrides[p.name])
+			elif p.name in self.year_transforms:
+				entry = {'strategy': 'year-transform'}
+			elif p.name in consumed or not self.scenario_input_dirs.get(p.name):
+				continue
+			elif p.dtype == 'cat':
+				entry = {'strategy': 'drop-in'}
+			else:
+				entry = {'strategy': 'mixture'}
+			if entry['strategy'] == 'none':
+				continue
+			if entry['strategy'] not in self._manipulation_strategies:
+				raise ValueError(f"unknown manipulation strategy '{entry['strategy']}' for {p.name}")
+			entry.setdefault('scenario_dir', self.scenario_input_dirs.get(p.name))
+			manipulations[p.name] = entry
+		return manipulations
+
+	_manipulation_strategies = (
+		'mixture', 'blend', 'delta', 'scale', 'drop-in', 'script-swap', 'year-transform',
+	)
+
+	def _apply_manipulation(self, params, name, entry):
+		"""
+		Apply one entry of the manipulation plan.
+
+		Args:
+			params (dict):
+				The parameters for this experiment, including both
+				exogenous uncertainties and policy levers.
+			name (str):
+				The parameter to apply.
+			entry (dict):
+				The strategy and options for this parameter.
+		"""
+		strategy = entry['strategy']
+		ve_scenario_dir = entry['scenario_dir']
+		options = {}
+		if 'no_mix_cols' in entry:
+			options['no_mix_cols'] = tuple(entry['no_mix_cols'])
+		if strategy == 'mixture':
+			if 'float_dtypes' in entry:
+				options['float_dtypes'] = entry['float_dtypes']
+			self._manipulate_by_mixture(params, name, ve_scenario_dir, **options)
+		elif strategy == 'blend':
+			self._manipulate_by_blend(params, name, entry)
+		elif strategy == 'delta':
+			self._manipulate_by_delta(params, name, ve_scenario_dir, **options)
+		elif strategy == 'scale':
+			self._manipulate_by_scale(params, entry.get('columns', {}), ve_scenario_dir)
+		elif strategy == 'drop-in':
+			self._manipulate_by_categorical_drop_in(params, name, ve_scenario_dir)
+		elif strategy == 'script-swap':
+			self._manipulate_by_categorical_drop_in(params, name, ve_scenario_dir, target='scripts')
+		elif strategy == 'year-transform':
+			self._manipulate_by_year_transform(params, name)
+
+	def _manipulate_by_categorical_drop_in(self, params, cat_param, ve_scenario_dir, target='inputs'):
 		"""
 		Copy in the relevant input files.
 
@@ -343,14 +981,92 @@ class VEModel(FilesCoreModel):
 			params (dict):
 				The parameters for this experiment, including both
 				exogenous uncertainties and policy levers.
+			cat_param:
+				The name of the categorical parameter, whose value
+				names the folder of files to copy
+			ve_scenario_dir:
+				The name of the directory that contains a folder
+				for each value of the parameter
+			target:
+				The model directory to copy the files into
 		"""
 		scenario_dir = params[cat_param]
+		for name, src in self._drop_in_scan(ve_scenario_dir, scenario_dir):
+			dst = join_norm(self.resolved_model_path, target, name)
+			with self._drop_in_lock:
+				previous = self._drop_in_linked.pop(dst, None)
+			if drop_in_file(src, dst, self.drop_in_links) != 'copy':
+				# Signed now, not when scanned, so files edited since are accepted.
+				info = os.stat(src)
+				with self._drop_in_lock:
+					self._drop_in_linked[dst] = (src, (info.st_size, info.st_mtime_ns))
+			if previous is not None and previous[0] != src and os.path.exists(previous[0]):
+				protect_drop_in(previous[0])
+
+	def _drop_in_scan(self, ve_scenario_dir, scenario_dir):
+		"""
+		The files in one level of a categorical parameter, cached.
+
+		Only the listing is cached; each file is signed when it is linked.
+
+		Returns:
+			list: (name, path) for each file.
+		"""
+		scan_key = (ve_scenario_dir, str(scenario_dir))
+		try:
+			return self._drop_in_scans[scan_key]
+		except KeyError:
+			pass
+		files = []
 		for i in os.scandir(scenario_input(ve_scenario_dir,scenario_dir)):
 			if i.is_file():
-				shutil.copyfile(
-					scenario_input(ve_scenario_dir,scenario_dir,i.name),
-					join_norm(self.resolved_model_path, 'inputs', i.name)
-				)
+				files.append((i.name, i.path))
+		self._drop_in_scans[scan_key] = files
+		return files
+
+	def _check_drop_in_links(self):
+		"""
+		Check that the model run did not change any linked drop-in files.
+
+		A linked drop-in shares its data with the file in Scenario-Inputs,
+		so if VE writes to it in place the scenario library is changed
+		for every later experiment.  The originals are made read-only
+		when linked, so this only catches a model that makes them
+		writable again.
+
+		Raises:
+			RuntimeError: If any linked drop-in file has changed.
+		"""
+		changed = self._changed_drop_in_links([self.resolved_model_path])
+		if changed:
+			raise RuntimeError(drop_in_changed_message(changed))
+
+	def _changed_drop_in_links(self, model_dirs, forget=False):
+		"""
+		The linked drop-in files changed since they were linked.
+
+		Args:
+			model_dirs (Collection[str]):
+				Check the links into these model directories.
+			forget (bool, default False):
+				Stop tracking these links, for model directories that
+				are done with.
+
+		Returns:
+			dict: The changed original for each linked path.
+		"""
+		prefixes = tuple(join_norm(d) + os.sep for d in model_dirs)
+		with self._drop_in_lock:
+			linked = [(dst, v) for dst, v in self._drop_in_linked.items() if join_norm(dst).startswith(prefixes)]
+			if forget:
+				for dst, _ in linked:
+					del self._drop_in_linked[dst]
+		changed = {}
+		for dst, (src, signature) in linked:
+			info = os.stat(src)
+			if (info.st_size, info.st_mtime_ns) != signature:
+				changed[dst] = src
+		return changed
 
 	def _manipulate_by_mixture(self, params, weight_param, ve_scenario_dir, no_mix_cols=('Year', 'Geo',), float_dtypes=False):
 		"""
@@ -422,6 +1138,58 @@ class VEModel(FilesCoreModel):
 				df1.replace(0, np.nan, inplace=True)
 			df1.to_csv(out_filename, index=False, float_format="%.5f", na_rep='NA')
 
+	def _manipulate_by_blend(self, params, param_name, entry):
+		"""
+		Prepare files by blending any number of anchor scenarios.
+
+		The anchor folders are read once per process into a `BlendBasis`,
+		so each experiment only computes one weighted sum per file.  With
+		two anchors "1" and "2" this gives the same files as
+		`_manipulate_by_mixture`.
+
+		Args:
+			params (dict):
+				The parameters for this experiment, including both
+				exogenous uncertainties and policy levers.
+			param_name:
+				The name of the parameter being applied
+			entry (dict):
+				The plan entry.  `anchors` lists the anchor folders in the
+				scenario directory (by default all its folders, in numeric
+				or name order).  The weights are piecewise-linear in the
+				parameter value between `knots` (by default evenly spaced
+				over 0 to 1), or if `weights` lists parameter names, those
+				give the weights of the second and later anchors, and the
+				first anchor gets the rest.
+		"""
+		ve_scenario_dir = entry['scenario_dir']
+		anchors = entry.get('anchors')
+		if anchors is None:
+			anchors = [i.name for i in os.scandir(scenario_input(ve_scenario_dir)) if i.is_dir()]
+			anchors.sort(key=lambda a: (0, int(a), a) if a.isdigit() else (1, 0, a))
+		no_mix_cols = tuple(entry.get('no_mix_cols', ('Year', 'Geo',)))
+		float_dtypes = bool(entry.get('float_dtypes', False))
+
+		basis_key = (ve_scenario_dir, tuple(anchors), no_mix_cols, float_dtypes)
+		basis = self._blend_bases.get(basis_key)
+		if basis is None:
+			basis = BlendBasis(
+				[scenario_input(ve_scenario_dir, str(a)) for a in anchors],
+				no_mix_cols=no_mix_cols,
+				float_dtypes=float_dtypes,
+			)
+			self._blend_bases[basis_key] = basis
+
+		if 'weights' in entry:
+			rest = np.array([params[p] for p in entry['weights']], dtype=np.float64)
+			weights = np.append(1.0 - rest.sum(), rest)
+		else:
+			knots = entry.get('knots')
+			if knots is None:
+				knots = np.linspace(0, 1, len(anchors))
+			weights = piecewise_weights(params[param_name], knots)
+		basis.write(weights, join_norm(self.resolved_model_path, 'inputs'))
+
 	def _manipulate_by_scale(self, params, param_map, ve_scenario_dir, max_thresh=1E9):
 		"""
 		Prepare files by multiplying fields with the scalar value.
@@ -530,6 +1298,91 @@ class VEModel(FilesCoreModel):
 			)
 			df1.to_csv(out_filename, index=False, float_format="%.5f")
 
+	def _year_transform_template(self, param_name):
+		"""
+		Load and index the template file for a year-indexed transform.
+
+		Templates are read once per model instance.  Alongside the data,
+		the row positions of each year and the years as an array are
+		kept so that each transform is a single vectorized operation.
+		"""
+		spec = self.year_transforms[param_name]
+		ve_scenario_dir = spec.get('scenario_dir', self.scenario_input_dirs.get(param_name))
+		filename = scenario_input(ve_scenario_dir, spec['file'])
+		cached = self._year_transform_templates.get(filename)
+		if cached is None:
+			template = pd.read_csv(filename)
+			years = template['Year'].to_numpy()
+			year_rows = {int(y): np.flatnonzero(years == y) for y in np.unique(years)}
+			cached = (template, years, year_rows)
+			self._year_transform_templates[filename] = cached
+		return cached
+
+	def _manipulate_by_year_transform(self, params, param_name):
+		"""
+		Prepare an input file by transforming a template by year.
+
+		The transform is defined declaratively in `year_transforms`
+		(see `DEFAULT_YEAR_TRANSFORMS`), so a new growth, insertion or
+		scaling parameter only needs a config entry.  Integer columns
+		are rounded and stay integers.  If the experiment has no value
+		for a parameter the entry uses, the file is left as it is.
+
+		Args:
+			params (dict):
+				The parameters for this experiment, including both
+				exogenous uncertainties and policy levers.
+			param_name (str):
+				The parameter whose entry in `year_transforms` to apply.
+		"""
+		spec = self.year_transforms[param_name]
+		template, years, year_rows = self._year_transform_template(param_name)
+		columns = spec['columns']
+		if not isinstance(columns, dict):
+			columns = {column: param_name for column in columns}
+		method = spec.get('method', 'insert')
+		missing = sorted(set(p for p in columns.values() if p not in params))
+		if missing:
+			_logger.info(f"YEAR TRANSFORM {param_name} skipped, no value for {', '.join(missing)}")
+			return
+
+		if 'years' in spec:
+			transform_years = [int(y) for y in spec['years']]
+		elif method == 'insert':
+			transform_years = [self.model_future_year]
+		else:
+			transform_years = None
+		if transform_years is None:
+			rows = slice(None)
+		else:
+			rows = np.concatenate([year_rows.get(y, np.empty(0, dtype=int)) for y in transform_years])
+
+		integer = [pd.api.types.is_integer_dtype(template[c]) for c in columns]
+		df = template.astype({c: np.float64 for c, is_int in zip(columns, integer) if not is_int})
+		col_idx = [df.columns.get_loc(c) for c in columns]
+		values = np.asarray([params[p] for p in columns.values()], dtype=np.float64)
+		block = df.iloc[rows, col_idx].to_numpy(dtype=np.float64)
+		if method == 'growth':
+			year_diff = (years[rows] - self.model_base_year)[:, None]
+			block = block * values[None, :] ** year_diff
+		elif method == 'scale':
+			block = block * values[None, :]
+		elif method == 'insert':
+			block = np.broadcast_to(values[None, :], block.shape)
+		else:
+			raise ValueError(f"unknown year transform method '{method}' for {param_name}")
+		for k, (column, j) in enumerate(zip(columns, col_idx)):
+			new = block[:, k]
+			if integer[k]:
+				new = np.round(new).astype(template[column].dtype)
+			df.iloc[rows, j] = new
+
+		out_filename = join_norm(
+			self.resolved_model_path, 'inputs', spec['file']
+		)
+		_logger.debug(f"writing updates to: {out_filename}")
+		df.to_csv(out_filename, index=False)
+
 	def _manipulate_ludensity(self, params):
 		"""
 		Prepare the urban mix proportion by marea
@@ -575,22 +1428,9 @@ class VEModel(FilesCoreModel):
 				exogenous uncertainties and policy levers.
 		"""
 
-		income_df = pd.read_csv(join_norm(scenario_input(self.scenario_input_dirs.get('INCOMEGROWTHRATE'),'azone_per_cap_inc.csv')))
+		return self._manipulate_by_year_transform(params, 'INCOMEGROWTHRATE')
 
-		unique_years = income_df.Year.unique()
-		base_year = self.model_base_year
 
-		for run_year in unique_years:
-			year_diff = run_year - base_year
-			income_df.loc[income_df.Year == run_year,['HHIncomePC.2005', 'GQIncomePC.2005']] = \
-			income_df.loc[income_df.Year == run_year,['HHIncomePC.2005', 'GQIncomePC.2005']] * (params['INCOMEGROWTHRATE'] ** year_diff)
-		
-		out_filename = join_norm(
-			self.resolved_model_path, 'inputs', 'azone_per_cap_inc.csv'
-		)
-		_logger.debug(f"writing updates to: {out_filename}")
-		income_df.to_csv(out_filename, index=False)
-		
 	def _manipulate_ldvecodrv(self, params):
 		"""
 		Prepate the LDV ecodrive penetration file.
@@ -624,17 +1464,8 @@ class VEModel(FilesCoreModel):
 				exogenous uncertainties and policy levers.
 		"""
 
-		shdcarsvc_occp_df = pd.read_csv(join_norm(scenario_input(self.scenario_input_dirs.get('SHDCARSVCOCCUPRATE'),'region_carsvc_shd_occup.csv')))
+		return self._manipulate_by_year_transform(params, 'SHDCARSVCOCCUPRATE')
 
-		future_year = self.model_future_year
-
-		shdcarsvc_occp_df.loc[shdcarsvc_occp_df.Year == future_year, 'ShdCarSvcAveOccup'] = params['SHDCARSVCOCCUPRATE']
-		
-		out_filename = join_norm(
-			self.resolved_model_path, 'inputs', 'region_carsvc_shd_occup.csv'
-		)
-		_logger.debug(f"writing updates to: {out_filename}")
-		shdcarsvc_occp_df.to_csv(out_filename, index=False)
 
 	def _manipulate_drvlessadj(self, params):
 		"""
@@ -658,18 +1489,8 @@ class VEModel(FilesCoreModel):
 				exogenous uncertainties and policy levers.
 		"""
 
-		drvless_veh_param_df = pd.read_csv(join_norm(scenario_input(self.scenario_input_dirs.get('DRVLESSPROPREMOTEACC'),'region_driverless_vehicle_parameter.csv')))
+		return self._manipulate_by_year_transform(params, 'DRVLESSPROPREMOTEACC')
 
-		future_year = self.model_future_year
-
-		drvless_veh_param_df.loc[drvless_veh_param_df.Year == future_year, 'PropRemoteAccess'] = params['DRVLESSPROPREMOTEACC']
-		drvless_veh_param_df.loc[drvless_veh_param_df.Year == future_year, 'PropParkingFeeAvoid'] = params['PROPPARKINGFEEAVOID']
-		
-		out_filename = join_norm(
-			self.resolved_model_path, 'inputs', 'region_driverless_vehicle_parameter.csv'
-		)
-		_logger.debug(f"writing updates to: {out_filename}")
-		drvless_veh_param_df.to_csv(out_filename, index=False)
 
 	def _manipulate_drvlessvehsales(self, params):
 		"""
@@ -812,14 +1633,7 @@ class VEModel(FilesCoreModel):
 				exogenous uncertainties and policy levers.
 		"""
 
-		scenario_dir = params['POWERTRAINSCEN']
-		ve_scenario_dir = self.scenario_input_dirs.get('POWERTRAINSCEN')
-		for i in os.scandir(scenario_input(ve_scenario_dir,scenario_dir)):
-			if i.is_file():
-				shutil.copyfile(
-					scenario_input(ve_scenario_dir,scenario_dir,i.name),
-					join_norm(self.resolved_model_path, 'scripts', i.name)
-				)
+		return self._manipulate_by_categorical_drop_in(params, 'POWERTRAINSCEN', self.scenario_input_dirs.get('POWERTRAINSCEN'), target='scripts')
 
 	def _manipulate_expand_roads(self, params):
 		"""
@@ -890,9 +1704,10 @@ class VEModel(FilesCoreModel):
 		"""
 		_logger.info(f"{self.config['model_type']} RUN ...")
 
-		os.environ['path'] = join_norm(self.config['r_executable'])+';'+os.environ['path']
-		
-		cmd = 'Rscript'
+		self._ensure_installed()
+		self._failure_stage('run')
+
+		r_env = self.r_environment()
 
 		# Script that opens the model and runs it
 		with open(join_norm(self.local_directory, "vemodel_runner.R"), "wt") as r_script:
@@ -909,12 +1724,16 @@ class VEModel(FilesCoreModel):
 		# will capture both stdout and stderr from the command line tool, and
 		# make these available in the result to facilitate debugging.
 		self.last_run_result = subprocess.run(
-			[cmd, 'vemodel_runner.R'],
+			[r_env.rscript, 'vemodel_runner.R'],
 			cwd=self.local_directory,
+			env=dict(r_env.env),
 			capture_output=True,
 		)
 		##Add errors log
 		if self.last_run_result.returncode:
+			stdout = self.last_run_result.stdout.decode(errors='replace')
+			stderr = self.last_run_result.stderr.decode(errors='replace')
+			self._record_failure(error_message(stderr), stdout + stderr)
 			raise subprocess.CalledProcessError(
 				self.last_run_result.returncode,
 				self.last_run_result.args,
@@ -925,6 +1744,9 @@ class VEModel(FilesCoreModel):
 			with open(join_norm(self.local_directory, self.modelname, 'results', 'stdout.log'), 'wb') as slog:
 				slog.write(self.last_run_result.stdout)
 
+		# Checked after the R result, so a failed run is reported as itself.
+		self._check_drop_in_links()
+
 		_logger.info(f"{self.config['model_type']} RUN complete")
 
 
@@ -1002,44 +1824,123 @@ class VEModel(FilesCoreModel):
 				If post process is not available for specified measure
 		"""
 	
-		extraction_script = self.config['extract_script']
-		if not os.path.exists(join_norm(self.local_directory, self.modelname, extraction_script)):
-			shutil.copy2(
-					join_norm(this_directory, extraction_script),
-					join_norm(self.local_directory, self.modelname, extraction_script),
-				)
+		self._failure_stage('post_process')
+		try:
+			extraction_script = self.config['extract_script']
+			if not os.path.exists(join_norm(self.local_directory, self.modelname, extraction_script)):
+				shutil.copy2(
+						join_norm(this_directory, extraction_script),
+						join_norm(self.local_directory, self.modelname, extraction_script),
+					)
 
-		cwd2 = join_norm(self.local_directory, self.modelname)
+			cwd2 = join_norm(self.local_directory, self.modelname)
 
-		# Ensuring R Exe path is in env.
-		os.environ['path'] = join_norm(self.config['r_executable'])+';'+os.environ['path']
+			r_env = self.r_environment()
 
-		# Ensure that R paths are set correctly.
-		r_runtime_path = self.config['r_runtime_path']
-		
-		with open(join_norm(self.local_directory, self.modelname, '.Rprofile'), 'wt') as rprof:
-			rprof.write(f'source(file.path("{r_runtime_path}", "VisionEval.R"), chdir=TRUE)')
+			### The subprocess.run command runs a command line tool.
+			self.postprocess_results = subprocess.run(
+				[r_env.rscript, extraction_script],
+				cwd=cwd2,
+				env=dict(r_env.env),
+				capture_output=True,
+			)
 
-		cmd = 'Rscript'
+			##Add errors log
+			if self.postprocess_results.returncode:
+				stdout = self.postprocess_results.stdout.decode(errors='replace')
+				stderr = self.postprocess_results.stderr.decode(errors='replace')
+				self._record_failure(error_message(stderr), stdout + stderr)
+				raise subprocess.CalledProcessError(
+					self.postprocess_results.returncode,
+					self.postprocess_results.args,
+					self.postprocess_results.stdout,
+					self.postprocess_results.stderr,
+				)
+			else:
+				with open(join_norm(self.resolved_model_path, 'results', 'postprocess_stdout.log'), 'wb') as slog:
+					slog.write(self.postprocess_results.stdout)
+
+			self._prune_datastore()
+		except Exception as err:
+			# run_model drops errors from post_process, so record them here.
+			self._record_failure(repr(err))
+			raise
+
+
+	def _prune_datastore(self):
+		"""
+		Reduce the run's Datastore to what the retention policy keeps.
+
+		With `datastore_retention` set to 'extraction', the year groups
+		of the model run are kept with only the tables read by the
+		extract script, along with any groups or `group/table` paths
+		matching a pattern in `datastore_keep`; everything else is
+		deleted.  With 'none' the whole Datastore is deleted.  What was
+		kept and dropped, with sizes, is written to
+		`datastore_manifest.json` in the output directory, so it is
+		included in the archive.
+		"""
+		if self.datastore_retention == 'all':
+			return
+		datastore = join_norm(self.resolved_model_path, 'results', self.config.get('datastore_name', 'Datastore'))
+		if not os.path.isdir(datastore):
+			_logger.debug(f"DATASTORE not pruned, no directory at {datastore}")
+			return
+
+		if self.datastore_retention == 'extraction':
+			tables = extraction_tables(join_norm(self.resolved_model_path, self.config['extract_script']))
+			groups = {str(self.model_base_year), str(self.model_future_year)}
+		else:
+			tables, groups = set(), set()
+
+		def size(path):
+			if os.path.isfile(path):
+				return os.path.getsize(path)
+			return sum(
+				os.path.getsize(os.path.join(root, f))
+				for root, _, files in os.walk(path) for f in files
+			)
 
-		### The subprocess.run command runs a command line tool.
-		self.postprocess_results = subprocess.run(
-			[cmd, extraction_script],
-			cwd=cwd2,
-			capture_output=True,
-		)
+		def keep(name):
+			return any(fnmatch.fnmatch(name, pattern) for pattern in self.datastore_keep)
 
-				##Add errors log
-		if self.postprocess_results.returncode:
-			raise subprocess.CalledProcessError(
-				self.postprocess_results.returncode,
-				self.postprocess_results.args,
-				self.postprocess_results.stdout,
-				self.postprocess_results.stderr,
-			)
-		else:
-			with open(join_norm(self.resolved_model_path, 'results', 'postprocess_stdout.log'), 'wb') as slog:
-				slog.write(self.postprocess_results.stdout)
+		kept, dropped = {}, {}
+		for group in os.scandir(datastore):
+			if not group.is_dir():
+				kept[group.name] = size(group.path)
+			elif self.datastore_retention == 'none' or not (group.name in groups or keep(group.name)):
+				dropped[group.name] = size(group.path)
+			else:
+				keep_group = keep(group.name)
+				for table in os.scandir(group.path):
+					name = f"{group.name}/{table.name}"
+					if not table.is_dir() or keep_group or table.name in tables or keep(name):
+						kept[name] = size(table.path)
+					else:
+						dropped[name] = size(table.path)
+
+		for name in dropped:
+			path = join_norm(datastore, name)
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			else:
+				os.remove(path)
+		if self.datastore_retention == 'none':
+			shutil.rmtree(datastore, ignore_errors=True)
+
+		output_path = join_norm(self.resolved_model_path, self.rel_output_path)
+		os.makedirs(output_path, exist_ok=True)
+		with open(join_norm(output_path, 'datastore_manifest.json'), 'wt') as f:
+			json.dump({
+				'retention': self.datastore_retention,
+				'keep': self.datastore_keep,
+				'kept': kept,
+				'dropped': dropped,
+			}, f, indent=1)
+		_logger.info(
+			f"DATASTORE pruned {len(dropped)} groups or tables, "
+			f"{sum(dropped.values()) / 2**20:.1f} MB freed, {sum(kept.values()) / 2**20:.1f} MB kept"
+		)
 
 
 	def archive(self, params, model_results_path=None, experiment_id=None):
@@ -1058,6 +1959,7 @@ class VEModel(FilesCoreModel):
 				`model_results_path` argument is given.
 
 		"""
+		self._failure_stage('archive')
 		if model_results_path is None:
 			if experiment_id is None:
 				db = getattr(self, 'db', None)
@@ -1067,12 +1969,612 @@ class VEModel(FilesCoreModel):
 		zipname = os.path.join(model_results_path, 'run_archive')
 		_logger.info(
 			f"VERSPM ARCHIVE\n"
-			f" from: {join_norm(self.local_directory, self.modelname, self.rel_output_path)}\n"
+			f" from: {join_norm(self.resolved_model_path, self.rel_output_path)}\n"
 			f"   to: {zipname}.zip"
 		)
 		shutil.make_archive(
 			zipname, 'zip',
-			root_dir=join_norm(self.local_directory, self.modelname),
+			root_dir=join_norm(self.resolved_model_path),
 			base_dir=self.rel_output_path,
 		)
 
+
+	def run_batch(self, model_dirs):
+		"""
+		Run and extract several prepared models in one R session.
+
+		VisionEval and the model packages are loaded once, and each model
+		directory is then opened, run and extracted in turn.  A failure
+		in one model is recorded and the session moves on to the next.
+
+		Args:
+			model_dirs (Collection[str]):
+				The model directories to run, each already set up for
+				its experiment and holding a copy of the extract script.
+
+		Returns:
+			dict:
+				For each model directory, a tuple of None if it ran and
+				was extracted, or else the error message as "stage: message",
+				and the seconds it took (None if it never started).
+		"""
+		self._ensure_installed()
+
+		# The runtime profile in the R environment loads VisionEval
+		# once for the whole batch.
+		r_env = self.r_environment()
+
+		handle, runner = tempfile.mkstemp(prefix='vemodel_batch_', suffix='.R', dir=self.local_directory)
+		os.close(handle)
+		dir_list = runner[:-2] + '.dirs'
+		status_file = runner[:-2] + '.status'
+		with open(dir_list, 'wt') as f:
+			f.writelines(r_join_norm(d) + "\n" for d in model_dirs)
+		with open(runner, 'wt') as r_script:
+			r_script.write(f"""
+			status_file <- "{r_join_norm(status_file)}"
+			for (model_dir in readLines("{r_join_norm(dir_list)}")) {{
+				started <- Sys.time()
+				stage <- "run"
+				status <- tryCatch({{
+					setwd(model_dir)
+					thismodel <- openModel(model_dir)
+					thismodel$run("reset")
+					stage <- "post_process"
+					setwd(model_dir)
+					sys.source(file.path(model_dir, "{self.config['extract_script']}"), envir=new.env(parent=globalenv()))
+					"OK"
+				}}, error = function(e) {{
+					paste("FAILED", stage, gsub("[\\t\\r\\n]+", " ", conditionMessage(e)), sep="\\t")
+				}})
+				elapsed <- as.numeric(difftime(Sys.time(), started, units="secs"))
+				cat(paste(model_dir, elapsed, status, sep="\\t"), "\\n", sep="", file=status_file, append=TRUE)
+			}}
+			""")
+
+		_logger.info(f"{self.config['model_type']} RUN BATCH of {len(model_dirs)} ...")
+		result = subprocess.run(
+			[r_env.rscript, os.path.basename(runner)],
+			cwd=self.local_directory,
+			env=dict(r_env.env),
+			capture_output=True,
+		)
+		changed = self._changed_drop_in_links(model_dirs, forget=True)
+
+		# Status lines are the model directory, seconds taken, and "OK"
+		# or "FAILED" with the stage and error message.
+		statuses = {}
+		durations = {}
+		if os.path.exists(status_file):
+			with open(status_file, 'rt') as f:
+				for line in f:
+					fields = line.rstrip("\n").split("\t")
+					if len(fields) >= 3:
+						statuses[fields[0]] = None if fields[2] == 'OK' else ": ".join(fields[3:]) or fields[2]
+						durations[fields[0]] = float(fields[1])
+		with open(runner[:-2] + '.log', 'wb') as slog:
+			slog.write(result.stdout)
+			slog.write(result.stderr)
+		for f in (runner, dir_list, status_file):
+			if os.path.exists(f):
+				os.remove(f)
+
+		outcome = {}
+		for d in model_dirs:
+			dir_key = r_join_norm(d)
+			if dir_key in statuses:
+				error = statuses[dir_key]
+			else:
+				stderr = result.stderr.decode(errors='replace').strip().splitlines()[-5:]
+				error = f"R session ended (return code {result.returncode}) before this model ran: " + " ".join(stderr)
+			changed_here = {dst: src for dst, src in changed.items() if join_norm(dst).startswith(join_norm(d) + os.sep)}
+			if changed_here and error is None:
+				error = "run: " + drop_in_changed_message(changed_here)
+			elif changed_here:
+				# The model's own failure is what is reported.
+				_logger.error(f"DROP-IN {d}: {drop_in_changed_message(changed_here)}")
+			outcome[d] = (error, durations.get(dir_key))
+		_logger.info(
+			f"{self.config['model_type']} RUN BATCH complete, "
+			f"{sum(error is None for error, _ in outcome.values())} of {len(outcome)} succeeded"
+		)
+		return outcome
+
+
+	def run_experiments_batch(self, design, batch_size=16, processes=1):
+		"""
+		Run experiments in batches, each batch in a single R session.
+
+		Each experiment is set up in its own copy of the installed model
+		under `batch/` in the local directory, and the prepared models
+		are run by `run_batch`, so R and the VE packages are started once
+		per batch rather than once per experiment.  The Datastore of each
+		experiment that succeeds is pruned as `datastore_retention` says,
+		and its measures are loaded, stored in the database and archived.
+		The success or failure of every experiment is kept in
+		`last_batch_status`.  Batches run in this process, not on dask
+		workers; use `processes` to run several batches at once.
+
+		Args:
+			design (pandas.DataFrame):
+				The experiments to run, indexed by experiment id, as
+				from `design_experiments`.
+			batch_size (int, default 16):
+				The most experiments run in one R session.
+			processes (int, default 1):
+				The number of R sessions to run at the same time.
+
+		Returns:
+			pandas.DataFrame:
+				The design, with the measures of each experiment (NaN
+				for experiments that failed).
+		"""
+		self._ensure_installed()
+		m_names = self.scope.get_measure_names()
+		param_names = set(self.scope.get_parameter_names())
+		installed_model = join_norm(self.local_directory, self.modelname)
+		extraction_script = self.config['extract_script']
+		base_model_path = self.model_path
+
+		prepared = {}
+		try:
+			for experiment_id, row in design.iterrows():
+				params = {k: v for k, v in row.items() if k in param_names}
+				model_dir = join_norm(self.local_directory, 'batch', str(experiment_id), self.modelname)
+				if os.path.isdir(model_dir):
+					shutil.rmtree(model_dir)
+				shutil.copytree(installed_model, model_dir)
+				shutil.copy2(join_norm(this_directory, extraction_script), join_norm(model_dir, extraction_script))
+				self.model_path = model_dir
+				self.setup(params)
+				prepared[experiment_id] = (params, model_dir)
+		finally:
+			self.model_path = base_model_path
+
+		model_dirs = [model_dir for _, model_dir in prepared.values()]
+		batches = [model_dirs[i:i + batch_size] for i in range(0, len(model_dirs), batch_size)]
+		outcome = {}
+		with ThreadPoolExecutor(max_workers=max(1, processes)) as pool:
+			futures = [(batch, pool.submit(self.run_batch, batch)) for batch in batches]
+			for batch, future in futures:
+				try:
+					outcome.update(future.result())
+				except Exception as err:
+					# A batch that fails as a whole fails each of its experiments.
+					_logger.exception(f"error running a batch of {len(batch)} experiments")
+					outcome.update({model_dir: (f"run: {err!r}", None) for model_dir in batch})
+
+		db = getattr(self, 'db', None)
+		if db is not None and db.readonly:
+			db = None
+		self.last_batch_status = {}
+		measures = {}
+		for experiment_id, (params, model_dir) in prepared.items():
+			error, duration = outcome[model_dir]
+			stage, _, message = error.partition(": ") if error else (None, None, None)
+			if stage not in ('run', 'post_process'):
+				stage, message = 'run', error
+			run_id = None
+			if db is not None:
+				run_id, _ = db.new_run_id(scope_name=self.scope.name, experiment_id=experiment_id, source=0)
+			if error is None:
+				self.model_path = model_dir
+				try:
+					self._prune_datastore()
+				except Exception as err:
+					_logger.exception(f"error pruning the Datastore of experiment {experiment_id}")
+					error = f"PROBLEM: {err!r}"
+					stage, message = 'post_process', repr(err)
+				finally:
+					self.model_path = base_model_path
+			if error is None:
+				try:
+					m = self.load_measures(m_names, abs_output_path=join_norm(model_dir, self.rel_output_path))
+				except Exception as err:
+					_logger.exception(f"error loading measures of experiment {experiment_id}")
+					error = f"PROBLEM: {err!r}"
+					stage, message = 'load_measures', repr(err)
+			if error is None:
+				measures[experiment_id] = m
+				if db is not None:
+					db.write_experiment_measures(self.scope.name, 0, pd.DataFrame(m, index=[experiment_id]), [run_id])
+				self.model_path = model_dir
+				try:
+					self.archive(params, experiment_id=experiment_id)
+				except Exception:
+					_logger.exception(f"error archiving experiment {experiment_id}")
+				finally:
+					self.model_path = base_model_path
+				shutil.rmtree(os.path.dirname(model_dir), ignore_errors=True)
+			else:
+				_logger.error(f"FAILED EXPERIMENT {experiment_id} in {model_dir}: {error}")
+				if db is not None:
+					db.write_experiment_run_status(self.scope.name, run_id, experiment_id, "FAILED")
+				self._store_failure(failure_record(
+					self.scope.name,
+					experiment_id,
+					params,
+					stage,
+					message,
+					log_text=self._ve_log_text(model_dir),
+					duration=duration,
+					run_id=run_id,
+				))
+				try:
+					ex_archive_path = self.get_experiment_archive_path(experiment_id, makedirs=True)
+				except MissingArchivePathError:
+					pass
+				else:
+					with open(os.path.join(ex_archive_path, 'error.log'), 'a') as errlog:
+						errlog.write(error)
+			self.last_batch_status[experiment_id] = error
+
+		results = design.copy()
+		m_df = pd.DataFrame.from_dict(measures, orient='index', columns=m_names)
+		return results.join(m_df.reindex(results.index))
+
+
+	def run_adaptive_experiments(
+			self,
+			initial_samples=None,
+			batch_size=8,
+			target_error=0.05,
+			max_experiments=200,
+			candidate_pool=2000,
+			evaluator=None,
+			design_name='adaptive',
+			random_seed=1234,
+	):
+		"""
+		Run experiments in batches chosen where the metamodel is uncertain.
+
+		An initial Latin hypercube design is run first.  After each batch
+		a shared-kernel Gaussian process metamodel is fit to the measures
+		listed in *metamodel_variables.csv*, and the next batch is picked
+		from a pool of candidate experiments to most reduce the predictive
+		uncertainty.  This continues until the leave-one-out error of every
+		listed measure is within `target_error`, or until `max_experiments`
+		have been run.
+
+		Args:
+			initial_samples (int, optional):
+				The size of the initial design.  Defaults to two
+				experiments per uncertainty and lever.
+			batch_size (int, default 8):
+				The number of experiments in each subsequent batch.
+				Matching this to the number of workers keeps them all busy.
+			target_error (float, default 0.05):
+				The leave-one-out root mean squared error, relative to the
+				standard deviation of each measure, at which to stop.
+			max_experiments (int, default 200):
+				The maximum total number of experiments to run.
+			candidate_pool (int, default 2000):
+				The number of candidate experiments to pick each batch from.
+			evaluator (emat.workbench.Evaluator, optional):
+				The evaluator passed to `run_experiments`, e.g. a dask
+				evaluator for parallel runs.
+			design_name (str, default "adaptive"):
+				The prefix for the design names stored in the database.
+			random_seed (int, default 1234):
+				A random seed for reproducibility.
+
+		Returns:
+			pandas.DataFrame, GaussianProcessMetamodel:
+				The parameters and measures of all experiments run, and
+				the metamodel fitted to them.
+		"""
+		measure_names = metamodel_variables(self.scope)
+		encoder = ScopeEncoder(self.scope)
+		if initial_samples is None:
+			initial_samples = 2 * len(encoder.parameter_names)
+
+		batch_name = f"{design_name}_0"
+		if self.db is not None and batch_name in self.db.read_design_names(self.scope.name):
+			# Resume a previous adaptive run; completed experiments short circuit.
+			design = self.db.read_experiment_parameters(self.scope.name, batch_name)
+		else:
+			design = self.design_experiments(
+				n_samples=initial_samples,
+				random_seed=random_seed,
+				design_name=batch_name,
+			)
+		results = self.run_experiments(design, evaluator=evaluator)
+
+		batch_number = 0
+		while True:
+			complete = results[measure_names].notnull().all(axis=1)
+			metamodel = GaussianProcessMetamodel().fit(
+				encoder.transform(results.loc[complete]),
+				results.loc[complete, measure_names],
+			)
+			errors = pd.Series(metamodel.loo_relative_error(), index=measure_names)
+			_logger.info(
+				f"ADAPTIVE batch {batch_number}: {complete.sum()} experiments, "
+				f"worst error {errors.max():.4f} ({errors.idxmax()})"
+			)
+			if errors.max() <= target_error or len(results) >= max_experiments:
+				break
+
+			batch_number += 1
+			batch_name = f"{design_name}_{batch_number}"
+			candidates = self.design_experiments(
+				n_samples=candidate_pool,
+				random_seed=random_seed + batch_number,
+				db=False,
+			)
+			n_picks = min(batch_size, max_experiments - len(results))
+			picks = metamodel.select_batch(encoder.transform(candidates), n_picks)
+			design = candidates.iloc[picks].copy()
+			if self.db is not None:
+				design.index = self.db.write_experiment_parameters(self.scope.name, batch_name, design)
+				design.index.name = 'experiment'
+			results = pd.concat([results, self.run_experiments(design, evaluator=evaluator)])
+
+		return results, metamodel
+
+
+	def fit_metamodels(self, design_name=None, measure_names=None):
+		"""
+		Fit metamodels for all listed measures from the stored experiments.
+
+		Fitted metamodels are cached and versioned in the database, keyed
+		by scope name and experiment set, so calling this again without
+		new experiments loads the cached fit, and calling it after new
+		experiments land warm starts from the previous version.
+
+		Args:
+			design_name (str or Collection[str], optional):
+				Limit the experiments to these designs.
+			measure_names (Collection[str], optional):
+				The measures to fit.  Defaults to the measures listed
+				in *metamodel_variables.csv*.
+
+		Returns:
+			MetamodelEngine
+
+		Raises:
+			ValueError: If there is no database, or no experiment has
+				every measure.
+		"""
+		if self.db is None:
+			raise ValueError("fitting metamodels requires a database")
+		return fit_metamodels(self.db, self.scope, design_name, measure_names)
+
+
+	def metamodel_service(self, measure_names=None, **kwargs):
+		"""
+		Start a service that refits metamodels as experiment results arrive.
+
+		Use this alongside an asynchronous or distributed batch to see
+		up-to-date predictions and error estimates before the batch ends.
+
+		Args:
+			measure_names (Collection[str], optional):
+				The measures to fit.  Defaults to the measures listed
+				in *metamodel_variables.csv*.
+			**kwargs:
+				Other arguments passed to `MetamodelService`.
+
+		Returns:
+			MetamodelService: The running service; call `stop` when done.
+		"""
+		database_path = getattr(self, '_sqlitedb_path', None)
+		if database_path is None:
+			raise ValueError("the metamodel service requires a SQLite database file")
+		return MetamodelService(database_path, self.scope, measure_names, **kwargs).start()
+
+
+	def optimize_levers(
+			self,
+			objectives=None,
+			weights=None,
+			top_k=4,
+			uncertainty_threshold=0.05,
+			confirm=True,
+			evaluator=None,
+			design_name='robust',
+			search_args=None,
+			**kwargs,
+	):
+		"""
+		Search for robust lever settings on the metamodel, and confirm with VE.
+
+		Candidate lever settings are evolved against a sample of scenarios
+		over the uncertainties, evaluated in batches with the metamodels.
+		Evaluations are cached in the database, so repeating a search on
+		the same experiments and settings is nearly free.  The best
+		candidates whose predictions are uncertain are then run in VE
+		across a few of the scenarios, using `evaluator` for parallel runs.
+
+		Args:
+			objectives (Mapping[str,str], optional):
+				'max' or 'min' for each measure to optimize.  Defaults to
+				the metamodel measures with a maximize or minimize kind.
+			weights (Mapping[str,float], optional):
+				Weights of the objectives.
+			top_k (int, default 4):
+				The number of candidates to confirm with VE runs.
+			uncertainty_threshold (float, default 0.05):
+				Only candidates with a relative predictive uncertainty
+				above this are confirmed.
+			confirm (bool, default True):
+				Whether to run the confirmation experiments.
+			evaluator (emat.workbench.Evaluator, optional):
+				The evaluator passed to `run_experiments`.
+			design_name (str, default "robust"):
+				The design name for the confirmation experiments.
+			search_args (dict, optional):
+				Arguments passed to `RobustOptimizer.search`.
+			**kwargs:
+				Other arguments passed to `RobustOptimizer`.
+
+		Returns:
+			pandas.DataFrame, pandas.DataFrame:
+				All candidates evaluated, best first, and the parameters
+				and measures of the confirmation runs (None if none ran).
+		"""
+		measure_names = None
+		if objectives is not None:
+			measure_names = list(dict.fromkeys(metamodel_variables(self.scope) + list(objectives)))
+		engine = self.fit_metamodels(measure_names=measure_names)
+		optimizer = RobustOptimizer(engine, self.scope, objectives, weights, **kwargs)
+		if self.db is not None:
+			optimizer.load(self.db)
+		results = optimizer.search(**(search_args or {}))
+		if self.db is not None:
+			optimizer.store(self.db)
+
+		confirmed = None
+		if confirm:
+			design = optimizer.confirmation_design(results, top_k, uncertainty_threshold)
+			if design.empty:
+				_logger.info("OPTIMIZE no uncertain candidates need confirmation")
+			else:
+				candidates = design.pop('_candidate_')
+				if self.db is not None:
+					design.index = self.db.write_experiment_parameters(self.scope.name, design_name, design)
+					design.index.name = 'experiment'
+				candidates.index = design.index
+				confirmed = self.run_experiments(design, evaluator=evaluator)
+				confirmed['_candidate_'] = candidates
+		return results, confirmed
+
+
+	def screen_parameters(self, design_name=None, measure_names=None, **kwargs):
+		"""
+		Screen the scope parameters for their effect on all measures.
+
+		Computes feature scores from the stored experiments, and Morris
+		elementary effects and Sobol indices from the fitted metamodels,
+		for all measures at once.  Results are cached in the database by
+		experiment set, so this is quick to repeat until new experiments
+		land.  Use `emat_ve_screening.influential_parameters` on the
+		result to find the parameters worth keeping in later designs.
+
+		Args:
+			design_name (str or Collection[str], optional):
+				Limit the experiments to these designs.
+			measure_names (Collection[str], optional):
+				The measures to screen.  Defaults to the measures listed
+				in *metamodel_variables.csv*.
+			**kwargs:
+				Other arguments passed to `screen_experiments`.
+
+		Returns:
+			dict: DataFrames of results, with a row per parameter
+			and a column per measure.
+		"""
+		if self.db is None:
+			raise ValueError("screening parameters requires a database")
+		return screen_experiments(self.db, self.scope, design_name, measure_names, **kwargs)
+
+
+	def scenario_explorer(self, design_name=None, measure_names=None, serve=False, **kwargs):
+		"""
+		Build a fast what-if explorer over the levers from the metamodels.
+
+		Args:
+			design_name (str or Collection[str], optional):
+				Limit the experiments to these designs.
+			measure_names (Collection[str], optional):
+				The measures to predict.  Defaults to the measures listed
+				in *metamodel_variables.csv*.
+			serve (bool, default False):
+				Also start a local HTTP service answering queries.
+			**kwargs:
+				Other arguments passed to `ExplorerService`.
+
+		Returns:
+			ScenarioExplorer or ExplorerService:
+				The explorer, or the running service if `serve` is True;
+				call `stop` on the service when done.
+		"""
+		explorer = ScenarioExplorer(self.fit_metamodels(design_name, measure_names), self.scope)
+		if serve:
+			return ExplorerService(explorer, **kwargs).start()
+		return explorer
+
+
+	def export_results(self, directory=None, design_name=None):
+		"""
+		Export stored experiments and measures to a columnar store.
+
+		Args:
+			directory (str, optional):
+				The root directory of the columnar store.  Defaults
+				to a *results* directory next to the database file.
+			design_name (str or Collection[str], optional):
+				Limit the export to these designs.
+
+		Returns:
+			str: The partition directory written for this scope.
+		"""
+		if self.db is None:
+			raise ValueError("exporting results requires a database")
+		if directory is None:
+			directory = join_norm(os.path.dirname(os.path.abspath(self.db.database_path)), 'results')
+		return export_experiments(self.db, self.scope, directory, design_name)
+
+
+	def failures(self, since=None, by=None, **kwargs):
+		"""
+		The failed experiments recorded in the database.
+
+		Failures are recorded by `run_model` and `run_experiments_batch`
+		in the `ve_failures` table, with the experiment id and parameters,
+		the stage that failed, the VE module running when it failed, an
+		error signature shared by failures with the same cause, and the
+		time from the start of the experiment to the failure.
+
+		Args:
+			since (float, optional):
+				Only failures recorded after this time (seconds since
+				the epoch), e.g. the start of the current batch.
+			by (str, optional):
+				'signature' to group the failures by cause (see
+				`failures_by_signature`), or 'region' to find the
+				parameter ranges where runs fail (see `failure_regions`),
+				compared against the completed runs in the database.
+			**kwargs:
+				Other arguments passed to `failure_regions`.
+
+		Returns:
+			pandas.DataFrame
+		"""
+		if self.db is None:
+			raise ValueError("reading failures requires a database")
+		failures = read_failures(self.db, self.scope.name, since)
+		if by is None:
+			return failures
+		if by == 'signature':
+			return failures_by_signature(failures)
+		if by == 'region':
+			completed = self.db.read_experiment_all(self.scope.name, None, only_with_measures=True)
+			return failure_regions(failures, completed, self.scope, **kwargs)
+		raise ValueError(f"failures can be grouped by signature or region, not {by}")
+
+
+	def drop_failure_regions(self, design, min_rate=0.5, **kwargs):
+		"""
+		Remove experiments in parameter regions where runs mostly fail.
+
+		Use this on a new design before running it, so runs are not spent
+		where the model is known to crash.
+
+		Args:
+			design (pandas.DataFrame):
+				The experiments to filter, as from `design_experiments`.
+			min_rate (float, default 0.5):
+				The failure rate of a region at which its experiments
+				are dropped.
+			**kwargs:
+				Other arguments passed to `failure_regions`.
+
+		Returns:
+			pandas.DataFrame: The experiments outside those regions.
+		"""
+		regions = self.failures(by='region', **kwargs)
+		flagged = in_failure_regions(design, regions, min_rate)
+		if flagged.any():
+			_logger.info(f"FAILURES dropping {flagged.sum()} of {len(design)} experiments in failing regions")
+		return design.loc[~flagged]